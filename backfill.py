@@ -0,0 +1,215 @@
+"""Бэкфилл истории: метки из экспорта Telegram Desktop (JSON) в базу бота без рассылки.
+
+    python backfill.py result.json --until 2024-03-01
+    python backfill.py result.json --dry-run          # только разобрать и посчитать
+
+Экспорт читается потоково (кусками, без загрузки файла целиком), из ветки TARGET_THREAD_ID
+берутся сообщения с геопозицией, регионы считаются пачками (RegionIndex.classify),
+метки ложатся в гистограммы FineStats (окно STATS_DAYS дней, более старые только считаются)
+и — если ещё не истёк TTL — в LocationStore. В базу всё пишется одним сбросом (гистограммы прибавляются
+к общим для кластера строкам stats_hours/stats_cells), в GitHub — один снимок (--publish).
+
+Запускать на остановленном боте: гистограммы из базы воркеры читают только при старте.
+"""
+import os
+import re
+import sys
+import json
+import time
+import asyncio
+import argparse
+from datetime import datetime
+
+# Модуль bot импортируется в main(), когда окружение уже настроено
+bot = None
+
+_MESSAGES = re.compile(r'"messages"\s*:\s*\[')
+_SEPARATOR = re.compile(r'[\s,]*')
+
+# --- РАЗБОР ЭКСПОРТА ---
+def iter_messages(path, chunk_size=1 << 20):
+    """Сообщения из массива "messages" по одному: JSONDecoder.raw_decode поверх буфера из кусков файла"""
+    decoder = json.JSONDecoder()
+    with open(path, encoding='utf-8') as f:
+        buf = ''
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            buf += chunk
+            match = _MESSAGES.search(buf)
+            if match:
+                buf = buf[match.end():]
+                break
+            # Ключ мог разрезаться на границе кусков
+            buf = buf[-64:]
+
+        pos, eof = 0, False
+        while True:
+            pos = _SEPARATOR.match(buf, pos).end()
+            if pos < len(buf) and buf[pos] == ']':
+                return
+            try:
+                if pos == len(buf):
+                    raise json.JSONDecodeError("нужны данные", buf, pos)
+                msg, pos = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                # Объект обрезан концом буфера: дочитываем и разбираем с его начала
+                if eof:
+                    raise
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buf, pos = buf[pos:] + chunk, 0
+                continue
+            yield msg
+
+def extract_locations(messages, thread_id, until=None):
+    """Метки ветки thread_id (0 — весь чат); ответы внутри ветки находятся по цепочке reply_to_message_id"""
+    in_thread = {thread_id}
+    for msg in messages:
+        if msg.get('type') != 'message':
+            continue
+        if thread_id and msg['id'] != thread_id:
+            if msg.get('reply_to_message_id') not in in_thread:
+                continue
+            in_thread.add(msg['id'])
+
+        point = msg.get('location_information')
+        if not point:
+            continue
+        # 'date' — время часового пояса машины, где делали экспорт; date_unixtime переводим
+        # во время сервера, как datetime.now() в handle_location
+        stamp = datetime.fromtimestamp(int(msg['date_unixtime'])).isoformat()
+        if until and stamp >= until:
+            continue
+        yield {
+            'latitude': point['latitude'],
+            'longitude': point['longitude'],
+            'timestamp': stamp,
+            'user': msg.get('from') or "Admin",
+            'message_id': msg['id'],
+            'report_count': 1,
+            'last_seen': stamp,
+        }
+
+# --- ЗАГРУЗКА ---
+class Backfill:
+    """Пачка меток -> регионы -> FineStats и свежие в LocationStore; повторный запуск не считает дважды"""
+
+    def __init__(self, bot_data, thread_id, batch_size):
+        self.bot_data = bot_data
+        self.batch_size = batch_size
+        self.batch = []
+        # Уже загруженное — диапазон message_id [lo, hi] из меток, попавших в статистику. Экспорт идёт
+        # по порядку, а окно — хвост по времени: метки старше lo при более широком окне загрузятся потом
+        self.mark_key = f"backfill:{thread_id}"
+        mark = bot_data.get(self.mark_key)
+        self.loaded_range = tuple(mark) if isinstance(mark, (list, tuple)) else (0, mark or 0)
+        self.stored = None
+        store = bot.get_location_store(bot_data)
+        self.existing = {loc.get('message_id') for loc in store}
+        self.cutoff = (datetime.now() - store.ttl).isoformat()
+        self.fresh = []
+        self.counts = {'parsed': 0, 'skipped': 0, 'loaded': 0, 'out_of_window': 0, 'in_store': 0, 'no_region': 0}
+
+    def add(self, loc):
+        self.counts['parsed'] += 1
+        lo, hi = self.loaded_range
+        if lo <= loc['message_id'] <= hi or loc['message_id'] in self.existing:
+            self.counts['skipped'] += 1
+            return
+        self.batch.append(loc)
+        if len(self.batch) >= self.batch_size:
+            self.flush_batch()
+
+    def flush_batch(self):
+        if not self.batch:
+            return
+        batch, self.batch = self.batch, []
+        rids = bot.region_index.classify([(loc['latitude'], loc['longitude']) for loc in batch])
+        for loc, rid in zip(batch, rids):
+            # Старше окна STATS_DAYS: не хранится нигде и в диапазон загруженного не входит
+            if not bot.fine_stats.record(loc, rid or 'other'):
+                self.counts['out_of_window'] += 1
+                continue
+            if rid is None:
+                self.counts['no_region'] += 1
+            if loc['timestamp'] >= self.cutoff:
+                self.fresh.append(loc)
+            self.counts['loaded'] += 1
+            mid = loc['message_id']
+            self.stored = (min(self.stored[0], mid), max(self.stored[1], mid)) if self.stored else (mid, mid)
+        bot.log_event("backfill_batch", size=len(batch), **self.counts)
+
+    def finish(self):
+        self.flush_batch()
+        if self.stored:
+            lo, hi = self.loaded_range
+            # Новый диапазон смыкается со старым: между ними экспорт сплошной, всё оттуда уже загружено
+            self.bot_data[self.mark_key] = [min(lo, self.stored[0]) if hi else self.stored[0], max(hi, self.stored[1])]
+        if self.fresh:
+            # Метки в хранилище лежат по времени: свежие из экспорта вклеиваем, а не дописываем в конец
+            store = bot.get_location_store(self.bot_data)
+            items = sorted([*store, *self.fresh], key=lambda loc: loc['timestamp'])
+            self.bot_data['locations'] = bot.LocationStore(items)
+            bot.location_store_ref[:] = [self.bot_data['locations']]
+            self.counts['in_store'] = len(self.fresh)
+        return self.counts
+
+async def persist(persistence, bot_data, publish):
+    persistence.attach(bot_data)
+    await persistence.flush_changes()
+    if publish and bot.GITHUB_MIRROR:
+        bot.publisher.start()
+        bot.publisher.enqueue(bot.build_snapshot(bot.get_location_store(bot_data)))
+        await bot.publisher.stop()
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="Хранятся только метки за последние STATS_DAYS дней (по умолчанию 28): более старые "
+               "попадут в out_of_window и загрузятся повторным запуском, если окно расширить."
+    )
+    parser.add_argument('export', help="result.json из Telegram Desktop (формат JSON)")
+    parser.add_argument('--db', default=None, help="файл базы; по умолчанию DB_FILE")
+    parser.add_argument('--thread', type=int, default=None, help="ветка; по умолчанию TARGET_THREAD_ID, 0 — весь чат")
+    parser.add_argument('--until', default="9999", help="брать метки раньше этой даты (запуск бота): позже они уже прошли через бота")
+    parser.add_argument('--batch', type=int, default=20000)
+    parser.add_argument('--dry-run', action='store_true', help="ничего не записывать")
+    parser.add_argument('--publish', action='store_true', help="выложить снимок меток в GitHub")
+    return parser.parse_args()
+
+def main():
+    global bot
+    args = parse_args()
+    # Лог прогресса по пачкам, без строк на каждую метку
+    os.environ.setdefault('LOG_LEVEL', 'INFO')
+    os.environ.setdefault('WORKER_ID', f"backfill-{os.getpid()}")
+    import bot as bot_module
+    bot = bot_module
+    bot.setup_logging()
+
+    thread_id = bot.TARGET_THREAD_ID if args.thread is None else args.thread
+    persistence = bot.SQLitePersistence(args.db or bot.DB_FILE)
+    bot_data = bot.load_state(persistence)
+
+    started = time.perf_counter()
+    backfill = Backfill(bot_data, thread_id, args.batch)
+    for loc in extract_locations(iter_messages(args.export), thread_id, args.until):
+        backfill.add(loc)
+    counts = backfill.finish()
+    elapsed = time.perf_counter() - started
+
+    if not args.dry_run:
+        persistence.mark_kv(backfill.mark_key)
+        asyncio.run(persist(persistence, bot_data, args.publish))
+
+    print(json.dumps({
+        **counts,
+        'seconds': round(elapsed, 2),
+        'points_per_sec': round(counts['parsed'] / elapsed) if elapsed else None,
+        'dry_run': args.dry_run,
+    }, ensure_ascii=False, indent=2))
+
+if __name__ == '__main__':
+    sys.exit(main())
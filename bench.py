@@ -0,0 +1,324 @@
+"""Офлайн-бенчмарк бота: фейковый Telegram Bot, локальная заглушка GitHub contents API,
+синтетические курьеры и штрафы по REGIONS.
+
+    python bench.py --subscribers 10000 --fines 1000 --out bench_results.json
+    python bench.py --baseline bench_results.json   # сравнить с прошлым прогоном
+
+Ничего наружу не ходит: Telegram подменён, GitHub поднимается на 127.0.0.1.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import hashlib
+import tracemalloc
+import resource
+import subprocess
+import threading
+from math import radians, sin, cos
+from base64 import b64decode
+from types import SimpleNamespace
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Модуль bot импортируется в main(), когда окружение уже настроено
+bot = None
+
+# --- ЗАГЛУШКА GITHUB ---
+class FakeGitHub(BaseHTTPRequestHandler):
+    """Contents API на один файл: GET с ETag/304, PUT с проверкой sha"""
+
+    files = {}      # path -> (sha, content)
+    calls = {}      # метод -> число запросов
+    lock = threading.Lock()
+
+    def _count(self):
+        with self.lock:
+            self.calls[self.command] = self.calls.get(self.command, 0) + 1
+
+    def _reply(self, status, body=None, headers=None):
+        data = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._count()
+        entry = self.files.get(self.path)
+        if entry is None:
+            return self._reply(404, {"message": "Not Found"})
+        etag = f'"{entry[0]}"'
+        if self.headers.get("If-None-Match") == etag:
+            return self._reply(304)
+        self._reply(200, {"sha": entry[0]}, {"ETag": etag})
+
+    def do_PUT(self):
+        self._count()
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        entry = self.files.get(self.path)
+        if entry is not None and payload.get("sha") != entry[0]:
+            return self._reply(409, {"message": "sha mismatch"})
+        content = b64decode(payload["content"])
+        sha = hashlib.sha1(content).hexdigest()
+        self.files[self.path] = (sha, content)
+        self._reply(200 if entry else 201, {"content": {"sha": sha}})
+
+    def log_message(self, *args):
+        pass
+
+def start_fake_github():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeGitHub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# --- ФЕЙКОВЫЙ TELEGRAM ---
+class FakeBot:
+    """Отвечает на send_location/send_message, считает вызовы и время доставки"""
+
+    def __init__(self, latency=0.0, blocked=()):
+        self.latency = latency
+        self.blocked = set(blocked)
+        self.calls = {}
+        self.received_at = None     # когда бот получил текущую метку (monotonic)
+        self.delivery = []          # задержки приём → последнее сообщение пользователю
+
+    async def _call(self, method, chat_id):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if chat_id in self.blocked:
+            raise bot.Forbidden("Forbidden: bot was blocked by the user")
+
+    async def send_location(self, chat_id, **kwargs):
+        await self._call('send_location', chat_id)
+
+    async def send_message(self, chat_id, **kwargs):
+        await self._call('send_message', chat_id)
+        self.delivery.append(time.monotonic() - self.received_at)
+
+# --- СЦЕНАРИЙ ---
+def random_point(region, rng):
+    """Случайная точка внутри круга района"""
+    lat, lon = region['coords']
+    r = region['radius'] * rng.random() ** 0.5
+    angle = rng.uniform(0, 6.283185307179586)
+    dlat = r * cos(angle) / 111.0
+    dlon = r * sin(angle) / (111.0 * cos(radians(lat)))
+    return lat + dlat, lon + dlon
+
+def make_users(count, rng, region_ids):
+    return {
+        100000 + i: bot.Subscriber(
+            bot.region_mask(rng.sample(region_ids, rng.randint(1, 3))),
+            notifications=rng.random() > 0.1
+        )
+        for i in range(count)
+    }
+
+def make_update(message_id, courier, lat, lon):
+    """Минимум полей Update, которые читает handle_location"""
+    post = SimpleNamespace(
+        chat=SimpleNamespace(id=bot.CHANNEL_ID, type='supergroup', title='bench'),
+        message_thread_id=bot.TARGET_THREAD_ID,
+        message_id=message_id,
+        from_user=SimpleNamespace(id=hash(courier) & 0x7fffffff, first_name=courier),
+        location=SimpleNamespace(latitude=lat, longitude=lon)
+    )
+    return SimpleNamespace(channel_post=post, message=None)
+
+def stage_timer(name, timings):
+    """Обёртка над функцией модуля bot: копит длительности вызовов"""
+    original = getattr(bot, name)
+
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await original(*args, **kwargs)
+        finally:
+            timings.setdefault(name, []).append(time.perf_counter() - started)
+
+    setattr(bot, name, wrapper)
+
+def summary(values):
+    values = sorted(values)
+    ms = lambda v: round(v * 1000, 3) if v is not None else None
+    return {
+        'count': len(values),
+        'mean_ms': ms(sum(values) / len(values)) if values else None,
+        'p50_ms': ms(bot.percentile(values, 50)),
+        'p95_ms': ms(bot.percentile(values, 95)),
+        'p99_ms': ms(bot.percentile(values, 99)),
+        'max_ms': ms(values[-1]) if values else None,
+    }
+
+async def run(args):
+    rng = random.Random(args.seed)
+    region_ids = list(bot.REGIONS)
+    couriers = [f"Courier{i}" for i in range(args.couriers)]
+    users = make_users(args.subscribers, rng, region_ids)
+    blocked = rng.sample(sorted(users), int(len(users) * args.blocked_ratio))
+
+    fake_bot = FakeBot(latency=args.api_latency, blocked=blocked)
+    # Лимит приёма выключен: бенчмарк меряет конвейер, а не троттлинг
+    limits = {'user': [0, 1], 'chat': [0, 1]}
+    app = SimpleNamespace(bot=fake_bot, bot_data={'users': users, 'admins': set(), 'ingest_limits': limits}, persistence=None)
+    context = SimpleNamespace(bot=fake_bot, bot_data=app.bot_data, application=app)
+    bot.subscriber_index.rebuild(users)
+    bot.publisher.start()
+
+    timings = {}
+    for name in ('save_data', 'notify_users'):
+        stage_timer(name, timings)
+
+    recent = []
+    interval = 3600 / args.fines_per_hour / args.speedup if args.fines_per_hour else 0
+    started = time.perf_counter()
+    for i in range(args.fines):
+        # Часть отчётов — повтор уже отмеченной точки (склейка в горячую точку)
+        if recent and rng.random() < args.dup_ratio:
+            lat, lon = rng.choice(recent)
+            lat += rng.uniform(-0.0003, 0.0003)
+            lon += rng.uniform(-0.0003, 0.0003)
+        else:
+            lat, lon = random_point(bot.REGIONS[rng.choice(region_ids)], rng)
+            recent = (recent + [(lat, lon)])[-50:]
+
+        update = make_update(1000 + i, rng.choice(couriers), lat, lon)
+        fake_bot.received_at = time.monotonic()
+        t0 = time.perf_counter()
+        await bot.handle_location(update, context)
+        timings.setdefault('handle_location', []).append(time.perf_counter() - t0)
+        if interval:
+            await asyncio.sleep(interval)
+    elapsed = time.perf_counter() - started
+
+    # Досылаем последнюю пачку в заглушку GitHub, чтобы посчитать все вызовы
+    await bot.publisher.stop()
+
+    store = bot.get_location_store(app.bot_data)
+    messages = sum(fake_bot.calls.values())
+    return {
+        'elapsed_s': round(elapsed, 3),
+        'throughput': {
+            'fines_per_s': round(args.fines / elapsed, 1),
+            'telegram_calls_per_s': round(messages / elapsed, 1),
+        },
+        'latency': {
+            'ingest_to_delivery': summary(fake_bot.delivery),
+            **{name: summary(values) for name, values in timings.items()},
+        },
+        'api_calls': {
+            'telegram': dict(fake_bot.calls),
+            'github': dict(FakeGitHub.calls),
+            'github_skipped_unchanged': bot.github_client.skipped,
+        },
+        'state': {
+            'locations': len(store),
+            'hotspots_merged': sum(loc.get('report_count', 1) - 1 for loc in store),
+            'users_left': len(app.bot_data['users']),
+            'publisher': bot.publisher.stats(),
+        },
+    }
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(result, baseline):
+    """Печатает изменение ключевых метрик относительно прошлого прогона"""
+    rows = [
+        ('fines/s', ('throughput', 'fines_per_s')),
+        ('delivery p50 ms', ('latency', 'ingest_to_delivery', 'p50_ms')),
+        ('delivery p95 ms', ('latency', 'ingest_to_delivery', 'p95_ms')),
+        ('delivery p99 ms', ('latency', 'ingest_to_delivery', 'p99_ms')),
+        ('handle_location p95 ms', ('latency', 'handle_location', 'p95_ms')),
+        ('save_data p95 ms', ('latency', 'save_data', 'p95_ms')),
+        ('peak traced MB', ('memory', 'traced_peak_mb')),
+    ]
+    print(f"\nсравнение с {baseline.get('revision')} ({baseline.get('started_at')}):")
+    for label, path in rows:
+        old, new = baseline, result
+        for key in path:
+            old = (old or {}).get(key)
+            new = (new or {}).get(key)
+        if old and new is not None:
+            print(f"  {label:<24} {old:>10} → {new:<10} {(new - old) / old * 100:+.1f}%")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--subscribers', type=int, default=10000)
+    parser.add_argument('--fines', type=int, default=1000)
+    parser.add_argument('--couriers', type=int, default=200)
+    parser.add_argument('--fines-per-hour', type=float, default=0, help="темп поступления; 0 — без пауз")
+    parser.add_argument('--speedup', type=float, default=3600, help="во сколько раз ускорить время при --fines-per-hour")
+    parser.add_argument('--dup-ratio', type=float, default=0.2, help="доля повторных отчётов о той же точке")
+    parser.add_argument('--blocked-ratio', type=float, default=0.01, help="доля пользователей, заблокировавших бота")
+    parser.add_argument('--api-latency', type=float, default=0.0, help="задержка фейкового Telegram API, сек")
+    parser.add_argument('--send-rate', type=float, default=1e6, help="лимит рассылки; 30 — как в проде")
+    parser.add_argument('--publish-window', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--out', default='bench_results.json')
+    parser.add_argument('--baseline', help="JSON прошлого прогона для сравнения")
+    return parser.parse_args()
+
+def main():
+    global bot
+    args = parse_args()
+    github = start_fake_github()
+
+    # Конфигурация бота читается при импорте — окружение готовим до него
+    os.environ.update({
+        'BOT_TOKEN': 'bench',
+        'GITHUB_TOKEN': 'bench',
+        'GITHUB_MIRROR': '1',
+        'GITHUB_API_URL': f"http://127.0.0.1:{github.server_address[1]}",
+        'PUBLISH_WINDOW': str(args.publish_window),
+        'SEND_RATE': str(args.send_rate),
+        'CHAT_MIN_INTERVAL': '0',
+        'LOG_LEVEL': os.getenv('LOG_LEVEL', 'WARNING'),
+        'WORKER_COUNT': '1',
+    })
+    import bot as bot_module
+    bot = bot_module
+    bot.setup_logging()
+
+    tracemalloc.start()
+    result = asyncio.run(run(args))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    github.shutdown()
+
+    # ru_maxrss в Linux — килобайты
+    result['memory'] = {
+        'traced_peak_mb': round(peak / 2**20, 2),
+        'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    result = {
+        'revision': git_revision(),
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'params': vars(args),
+        **result,
+    }
+
+    with open(args.out, 'w') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(json.dumps({k: result[k] for k in ('throughput', 'latency', 'api_calls', 'memory')}, ensure_ascii=False, indent=2))
+    print(f"\nрезультаты: {args.out}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(result, json.load(f))
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,27 @@
 import os
 import json
+import logging
+import pickle
+import sqlite3
+import hashlib
+import gzip
+import time
+import asyncio
 import threading
+import functools
+import weakref
+import contextlib
+import itertools
+import secrets
+import sys
 import requests
-from flask import Flask
-from datetime import datetime
+from math import radians, sin, cos, sqrt, atan2, floor
+from flask import Flask, Response, request, stream_with_context
+from datetime import datetime, date, timedelta
+from zoneinfo import ZoneInfo
+from collections import deque
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 from base64 import b64encode
 from telegram import Update, WebAppInfo, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
 from telegram.ext import (
@@ -13,8 +31,19 @@ from telegram.ext import (
     filters, 
     ContextTypes, 
     CallbackQueryHandler, 
-    PicklePersistence
+    BasePersistence,
+    PersistenceInput,
+    CallbackContext
 )
+from telegram.error import RetryAfter, Forbidden, BadRequest, NetworkError
+try:
+    import numpy as np
+except ImportError:  # без numpy пакетная классификация идёт через сетку поточечно
+    np = None
+try:
+    import brotli
+except ImportError:  # без brotli отдаём gzip
+    brotli = None
 
 # --- КОНФИГУРАЦИЯ ---
 BOT_TOKEN = os.getenv("BOT_TOKEN")
@@ -24,128 +53,2637 @@ CHANNEL_USERNAME = "@WoltIsrael2023"
 CHANNEL_ID = -1001234567890  # ⚠️ НУЖНО УЗНАТЬ ПРАВИЛЬНЫЙ ID
 TARGET_THREAD_ID = 53764
 WEBAPP_URL = "https://misha671.github.io/wolt-fines-map/"
+# Публичный адрес этого сервера: карта берёт метки прямо отсюда, GitHub остаётся зеркалом
+PUBLIC_URL = os.getenv("PUBLIC_URL", "").rstrip("/")
+if PUBLIC_URL:
+    WEBAPP_URL = f"{WEBAPP_URL}?api={PUBLIC_URL}"
 
 GITHUB_USERNAME = "misha671"
 GITHUB_REPO = "wolt-fines-map"
 GITHUB_FILE = "locations.json"
+# Базовый URL API можно подменить (GitHub Enterprise, локальная заглушка в bench.py)
+GITHUB_API_URL = os.getenv("GITHUB_API_URL", "https://api.github.com").rstrip("/")
 SUPER_ADMIN_ID = 913627492
 
+# Логи: уровень (DEBUG=1 включает подробные строки по каждому пользователю) и формат json|text
+LOG_LEVEL = os.getenv("LOG_LEVEL", "DEBUG" if os.getenv("DEBUG") else "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+
+# Webhook-режим (включается WEBHOOK_URL): один ASGI-сервер на event loop бота вместо polling + Flask
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+# Без WEBHOOK_SECRET секрет случайный на процесс — в кластере он обязан быть общим (см. main)
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 40))
+SERVER_CONCURRENCY = int(os.getenv("SERVER_CONCURRENCY", 1000))
+
+# Хранилище: SQLite (WAL) и старый pickle, из которого делаем одноразовую миграцию
+DB_FILE = os.getenv("DB_FILE", "bot_data.sqlite3")
+PICKLE_FILE = os.getenv("PICKLE_FILE", "bot_data.pickle")
+PERSISTENCE_INTERVAL = float(os.getenv("PERSISTENCE_INTERVAL", 60))
+
+# Несколько воркеров (только webhook-режим за балансировщиком) над одним DB_FILE:
+# WORKER_INDEX из WORKER_COUNT — своя доля рассылки, GitHub публикует только лидер по аренде
+WORKER_COUNT = int(os.getenv("WORKER_COUNT", 1))
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", 0))
+WORKER_ID = os.getenv("WORKER_ID") or f"worker{WORKER_INDEX}-{os.getpid()}-{secrets.token_hex(3)}"
+LEASE_TTL = float(os.getenv("LEASE_TTL", 15))
+CLUSTER_SYNC_INTERVAL = float(os.getenv("CLUSTER_SYNC_INTERVAL", 1))
+# Апдейты пользователя разбирает один воркер (uid % WORKER_COUNT); чужие передаются через базу с таким опросом
+CLUSTER_ROUTE_INTERVAL = float(os.getenv("CLUSTER_ROUTE_INTERVAL", 0.1))
+FANOUT_MAX_AGE = float(os.getenv("FANOUT_MAX_AGE", 300))
+CLUSTER_RETENTION = float(os.getenv("CLUSTER_RETENTION", 3600))
+
+# Апдейты разбираются параллельно (до UPDATE_CONCURRENCY сразу): медленная рассылка не держит кнопки и /start
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", 64))
+
+# Рассылка: Telegram пускает ~30 сообщений/сек на бота и ~1 сообщение/сек в один чат
+SEND_RATE = float(os.getenv("SEND_RATE", 30))
+SEND_CONCURRENCY = int(os.getenv("SEND_CONCURRENCY", 20))
+CHAT_MIN_INTERVAL = float(os.getenv("CHAT_MIN_INTERVAL", 1))
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", 3))
+
+# Лимит приёма меток (в минуту и запас подряд) на отправителя и на чат; админы меняют через /ratelimit, 0 — без лимита
+INGEST_USER_PER_MIN = float(os.getenv("INGEST_USER_PER_MIN", 4))
+INGEST_USER_BURST = int(os.getenv("INGEST_USER_BURST", 3))
+INGEST_CHAT_PER_MIN = float(os.getenv("INGEST_CHAT_PER_MIN", 30))
+INGEST_CHAT_BURST = int(os.getenv("INGEST_CHAT_BURST", 10))
+
+# Часовой пояс пользователей: тихие часы и часы/дни недели в статистике (хостинги обычно живут в UTC)
+LOCAL_TZ = ZoneInfo(os.getenv("BOT_TIMEZONE", "Asia/Jerusalem"))
+
+# Режимы доставки: сводка раз в N минут и тихие часы (по LOCAL_TZ); задача сводок тикает раз в DIGEST_TICK сек
+DIGEST_CHOICES = (15, 30, 60)
+QUIET_CHOICES = ((23, 7), (22, 8), (0, 6))
+DIGEST_TICK = float(os.getenv("DIGEST_TICK", 60))
+DIGEST_MAX_ITEMS = 50
+
+# Брошенные черновики диалогов (выбор регионов, ожидание точки зоны) удаляются через DRAFT_TTL_HOURS часов
+DRAFT_TTL_HOURS = float(os.getenv("DRAFT_TTL_HOURS", 24))
+
+# Метки живут LOCATIONS_TTL_HOURS часов (карта всё равно показывает 4 часа), но не больше LOCATIONS_MAX штук
+LOCATIONS_TTL_HOURS = float(os.getenv("LOCATIONS_TTL_HOURS", 4))
+LOCATIONS_MAX = int(os.getenv("LOCATIONS_MAX", 1000))
+LOCATIONS_PRUNE_INTERVAL = float(os.getenv("LOCATIONS_PRUNE_INTERVAL", 60))
+
+# Склейка повторных меток: отчёты ближе DEDUP_RADIUS_M метров в пределах DEDUP_WINDOW_MIN минут — одна точка
+DEDUP_RADIUS_M = float(os.getenv("DEDUP_RADIUS_M", 150))
+DEDUP_WINDOW_MIN = float(os.getenv("DEDUP_WINDOW_MIN", 20))
+
+# Личные зоны оповещения: точка пользователя + радиус (км) из ZONE_RADIUS_CHOICES; шаг сетки индекса зон
+ZONE_RADIUS_CHOICES = (1, 2, 3, 5)
+GEOFENCE_CELL_DEG = float(os.getenv("GEOFENCE_CELL_DEG", 0.02))
+
+# Статистика меток: окно скользящих гистограмм (дней) и шаг сетки тепловой карты (градусы, ~1 км)
+STATS_DAYS = int(os.getenv("STATS_DAYS", 28))
+HEATMAP_CELL_DEG = float(os.getenv("HEATMAP_CELL_DEG", 0.01))
+
+# Компактный экспорт: координаты квантуются до 1/COMPACT_SCALE градуса (1e-5° ≈ 1 м)
+COMPACT_SCALE = 100000
+
+# Лента изменений для карты: сколько событий помнить для дельт и как часто слать keepalive в SSE
+FEED_HISTORY = int(os.getenv("FEED_HISTORY", 5000))
+SSE_KEEPALIVE = float(os.getenv("SSE_KEEPALIVE", 15))
+
+# Публикация в GitHub: окно склейки (сек), число повторов и базовая пауза бэкоффа (сек)
+GITHUB_MIRROR = os.getenv("GITHUB_MIRROR", "1" if GITHUB_TOKEN else "0") == "1"
+PUBLISH_WINDOW = float(os.getenv("PUBLISH_WINDOW", 5))
+PUBLISH_MAX_RETRIES = int(os.getenv("PUBLISH_MAX_RETRIES", 5))
+PUBLISH_BACKOFF = float(os.getenv("PUBLISH_BACKOFF", 2))
+
+# --- ЛОГИ ---
+class JsonFormatter(logging.Formatter):
+    """Одна строка JSON на событие: ts, level, event и поля события"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'event': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        fields = " ".join(f"{k}={v}" for k, v in getattr(record, 'fields', {}).items())
+        line = f"{datetime.fromtimestamp(record.created):%H:%M:%S} {record.levelname:<7} {record.getMessage()} {fields}"
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+log = logging.getLogger("wolt_bot")
+
+def setup_logging():
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else TextFormatter())
+    logging.basicConfig(level=LOG_LEVEL, handlers=[handler], force=True)
+    # httpx пишет INFO на каждый запрос к Telegram API — это и есть основной шум
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+def log_event(event, level=logging.INFO, exc_info=False, **fields):
+    """Структурное событие; поля не форматируются, если уровень выключен"""
+    if log.isEnabledFor(level):
+        log.log(level, event, exc_info=exc_info, extra={'fields': fields})
+
+# --- МЕТРИКИ ---
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+COUNT_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+class Metrics:
+    """Счётчики, гистограммы и gauge в памяти процесса с выводом в текстовом формате Prometheus"""
+
+    def __init__(self):
+        self._lock = threading.Lock()  # пишет event loop, читает поток Flask
+        self._meta = {}                # name -> (type, help, buckets)
+        self._values = {}              # (name, labels) -> число или [бакеты..., sum, count]
+        self._gauges = {}              # name -> функция, вызывается при выдаче
+
+    def counter(self, name, help_text):
+        self._meta[name] = ('counter', help_text, None)
+
+    def histogram(self, name, help_text, buckets=SECONDS_BUCKETS):
+        self._meta[name] = ('histogram', help_text, buckets)
+
+    def gauge(self, name, help_text, fn):
+        self._meta[name] = ('gauge', help_text, None)
+        self._gauges[name] = fn
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        buckets = self._meta[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self._values.get(key)
+            if hist is None:
+                hist = self._values[key] = [0] * (len(buckets) + 2)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    hist[i] += 1
+                    break
+            hist[-2] += value
+            hist[-1] += 1
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+    def render(self):
+        with self._lock:
+            values = {key: (list(v) if isinstance(v, list) else v) for key, v in self._values.items()}
+        
+        lines = []
+        for name, (kind, help_text, buckets) in self._meta.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == 'gauge':
+                lines.append(f"{name} {self._gauges[name]()}")
+                continue
+            for (n, labels), value in values.items():
+                if n != name:
+                    continue
+                if kind == 'counter':
+                    lines.append(f"{name}{self._labels(labels)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets, value):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {value[-1]}")
+                lines.append(f"{name}_sum{self._labels(labels)} {value[-2]}")
+                lines.append(f"{name}_count{self._labels(labels)} {value[-1]}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.histogram("wolt_handler_seconds", "Время работы хендлера")
+metrics.counter("wolt_handler_errors_total", "Исключения в хендлерах")
+metrics.histogram("wolt_github_publish_seconds", "Длительность одной попытки публикации в GitHub")
+metrics.counter("wolt_github_publish_failures_total", "Неудачные попытки публикации в GitHub")
+metrics.counter("wolt_github_api_calls_total", "Запросы к GitHub contents API")
+metrics.histogram("wolt_fanout_recipients", "Получателей на одну метку", COUNT_BUCKETS)
+metrics.histogram("wolt_fanout_seconds", "Длительность рассылки одной метки")
+metrics.counter("wolt_notifications_total", "Результаты доставки уведомлений")
+metrics.counter("wolt_digests_total", "Результаты доставки сводок")
+metrics.histogram("wolt_persistence_flush_seconds", "Длительность сброса в SQLite")
+metrics.counter("wolt_webhook_rejected_total", "Запросы к webhook с неверным секретом")
+metrics.counter("wolt_ingest_throttled_total", "Метки, отклонённые лимитом приёма")
+metrics.gauge("wolt_publish_queue_depth", "Сохранений, ждущих публикации", lambda: publisher.queue_depth)
+metrics.gauge("wolt_send_in_flight", "Пользователей в процессе доставки", lambda: sender.in_flight)
+metrics.gauge("wolt_locations", "Меток в памяти", lambda: len(location_store_ref[0]) if location_store_ref else 0)
+metrics.gauge("wolt_cluster_leader", "1, если этот воркер публикует в GitHub", lambda: int(cluster.is_leader))
+
+def timed(name):
+    """Декоратор корутины: время -> wolt_handler_seconds{handler=name}, исключения -> счётчик"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            except Exception:
+                metrics.inc("wolt_handler_errors_total", handler=name)
+                raise
+            finally:
+                metrics.observe("wolt_handler_seconds", time.perf_counter() - started, handler=name)
+        wrapper.timed = True
+        return wrapper
+    return decorator
+
+def instrument_handlers(app):
+    """Оборачивает в timed() колбэки всех зарегистрированных хендлеров — новые замеряются сами"""
+    for handlers in app.handlers.values():
+        for handler in handlers:
+            if not getattr(handler.callback, 'timed', False):
+                handler.callback = timed(handler.callback.__name__)(handler.callback)
+
+class Startup:
+    """Фазы холодного старта (мс) и готовность: /ready отвечает 200, только когда бот разбирает апдейты"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.phases = {}
+        self.ready_at = None
+        self._preload = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases[name] = round((time.monotonic() - started) * 1000, 1)
+            log_event("startup_phase", phase=name, ms=self.phases[name])
+
+    def preload(self, fn, *args):
+        """Запускает fn в фоновом потоке прямо сейчас; результат заберёт post_init"""
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="preload")
+        self._preload = executor.submit(fn, *args)
+        executor.shutdown(wait=False)
+
+    async def preloaded(self):
+        if self._preload is None:
+            return None
+        return await asyncio.wrap_future(self._preload)
+
+    @property
+    def ready(self):
+        return self.ready_at is not None
+
+    def mark_ready(self):
+        if self.ready_at is None:
+            self.ready_at = time.monotonic()
+            log_event("startup_ready", ms=round((self.ready_at - self.started) * 1000, 1), **self.phases)
+
+    def stats(self):
+        return {
+            'ready': self.ready,
+            'uptime': round(time.monotonic() - self.started, 1),
+            'ready_after_ms': round((self.ready_at - self.started) * 1000, 1) if self.ready else None,
+            'phases': dict(self.phases),
+        }
+
+startup = Startup()
+metrics.gauge("wolt_ready", "1, когда бот принимает апдейты", lambda: int(startup.ready))
+
 # --- FLASK SERVER ---
 server = Flask(__name__)
 
-@server.route('/')
-def home():
-    return "Bot is running!", 200
+@server.route('/')
+def home():
+    return "Bot is running!", 200
+
+def health_payload():
+    """Liveness: процесс жив и отвечает, даже пока бот ещё стартует"""
+    return {
+        "status": "ok", "message": "I am alive!", "ready": startup.ready,
+        "publisher": publisher.stats(), "cluster": cluster.stats()
+    }
+
+def ready_payload():
+    """Readiness: (200, ...) только после загрузки состояния и запуска polling/webhook"""
+    status = "ready" if startup.ready else "starting"
+    return (200 if startup.ready else 503), {"status": status, "startup": startup.stats()}
+
+def sse_event(delta):
+    return f"id: {delta['cursor']}\nevent: delta\ndata: {json.dumps(delta, ensure_ascii=False)}\n\n"
+
+@server.route('/health')
+def health_check():
+    return health_payload(), 200
+
+@server.route('/ready')
+def ready_check():
+    status, payload = ready_payload()
+    return payload, status
+
+@server.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@server.route('/locations.json')
+def locations_json():
+    status, headers, body = location_snapshot.serve(
+        request.headers.get('If-None-Match'),
+        request.headers.get('Accept-Encoding', '')
+    )
+    return Response(body, status=status, headers=headers)
+
+@server.route('/locations.compact.json')
+def locations_compact_json():
+    status, headers, body = compact_snapshot.serve(
+        request.headers.get('If-None-Match'),
+        request.headers.get('Accept-Encoding', '')
+    )
+    return Response(body, status=status, headers=headers)
+
+FEED_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'Access-Control-Allow-Origin': '*',
+}
+SSE_HEADERS = dict(FEED_HEADERS, **{'X-Accel-Buffering': 'no'})
+
+def feed_delta(cursor, fmt=None):
+    """Дельта ленты; format=compact — добавленные метки колонками, как в locations.compact.json"""
+    delta = location_feed.since(cursor)
+    if delta is not None and fmt == 'compact':
+        delta['added'] = encode_compact(delta['added'])
+    return delta
+
+@server.route('/stats.json')
+def stats_json():
+    return Response(json.dumps(stats_payload(), ensure_ascii=False), mimetype='application/json', headers=FEED_HEADERS)
+
+@server.route('/locations/since')
+def locations_since():
+    delta = feed_delta(request.args.get('cursor'), request.args.get('format'))
+    if delta is None:
+        # Ничего не поменялось — пустой ответ без тела
+        return Response(status=204, headers=FEED_HEADERS)
+    return Response(json.dumps(delta, ensure_ascii=False), mimetype='application/json', headers=FEED_HEADERS)
+
+@server.route('/locations/stream')
+def locations_stream():
+    # EventSource при переподключении сам присылает последний id в Last-Event-ID
+    cursor = request.headers.get('Last-Event-ID') or request.args.get('cursor')
+    fmt = request.args.get('format')
+
+    def stream(cursor):
+        yield "retry: 5000\n\n"
+        while True:
+            delta = feed_delta(cursor, fmt)
+            if delta is not None:
+                cursor = delta['cursor']
+                yield sse_event(delta)
+            if not location_feed.wait(cursor, SSE_KEEPALIVE):
+                yield ": keepalive\n\n"
+
+    return Response(stream_with_context(stream(cursor)), mimetype='text/event-stream', headers=SSE_HEADERS)
+
+def run_flask():
+    port = int(os.environ.get("PORT", 10000))
+    server.run(host='0.0.0.0', port=port)
+
+# --- РЕГИОНЫ ---
+REGIONS = {
+    'tel_aviv': {'name': 'Тель-Авив', 'coords': (32.0853, 34.7818), 'radius': 8},
+    'rishon': {'name': 'Ришон ле-Цион', 'coords': (31.9730, 34.7925), 'radius': 7},
+    'bat_yam': {'name': 'Бат-Ям', 'coords': (32.0178, 34.7478), 'radius': 5},
+    'ramat_gan': {'name': 'Рамат-Ган', 'coords': (32.0806, 34.8239), 'radius': 5},
+    'holon': {'name': 'Холон', 'coords': (32.0167, 34.7667), 'radius': 5},
+    'givatayim': {'name': 'Гиватаим', 'coords': (32.0706, 34.8106), 'radius': 4},
+    'petach_tikva': {'name': 'Петах-Тиква', 'coords': (32.0900, 34.8878), 'radius': 7},
+    'netanya': {'name': 'Нетания', 'coords': (32.3314, 34.8467), 'radius': 6},
+    'herzliya': {'name': 'Герцлия', 'coords': (32.1661, 34.8367), 'radius': 5},
+    'raanana': {'name': 'Раанана', 'coords': (32.1858, 34.8706), 'radius': 5},
+    'kfar_saba': {'name': 'Кфар-Саба', 'coords': (32.1764, 34.9064), 'radius': 5},
+    'haifa': {'name': 'Хайфа', 'coords': (32.7940, 34.9896), 'radius': 10},
+    'jerusalem': {'name': 'Иерусалим', 'coords': (31.7683, 35.2137), 'radius': 10},
+    'beersheba': {'name': 'Беэр-Шева', 'coords': (31.2518, 34.7913), 'radius': 8},
+    'ashdod': {'name': 'Ашдод', 'coords': (31.8044, 34.6553), 'radius': 6},
+    'ashkelon': {'name': 'Ашкелон', 'coords': (31.6688, 34.5742), 'radius': 6}
+}
+
+# Подписка на регионы — битовая маска: бит i = REGION_ORDER[i]. Порядок сохраняется в базе (kv region_bits),
+# так что новые регионы можно добавлять куда угодно — маски перекодируются при загрузке
+REGION_ORDER = tuple(REGIONS)
+REGION_BITS = {rid: 1 << i for i, rid in enumerate(REGION_ORDER)}
+assert len(REGION_ORDER) <= 64, "маска регионов хранится в uint64"
+
+def region_mask(rids, bits=REGION_BITS):
+    mask = 0
+    for rid in rids:
+        mask |= bits.get(rid, 0)
+    return mask
+
+def mask_regions(mask, order=REGION_ORDER):
+    return [rid for i, rid in enumerate(order) if mask >> i & 1]
+
+# --- МЕТКИ ---
+class LocationFeed:
+    """Журнал изменений меток с курсором: дельты для /locations/since и push для SSE"""
+
+    def __init__(self, history=FEED_HISTORY):
+        # epoch меняется при рестарте — курсоры прошлого процесса получат полный сброс
+        self.epoch = secrets.token_hex(4)
+        self.seq = 0
+        self.events = deque(maxlen=history)  # (seq, op, payload)
+        self._cond = threading.Condition()
+        self._waiters = set()  # (loop, future) асинхронных подписчиков (SSE в ASGI)
+
+    def cursor(self, seq=None):
+        return f"{self.epoch}-{self.seq if seq is None else seq}"
+
+    def _parse(self, cursor):
+        epoch, _, seq = (cursor or '').partition('-')
+        if epoch != self.epoch or not seq.isdigit():
+            return None
+        seq = int(seq)
+        # Курсор из будущего или уже вытесненный из журнала — только полный сброс
+        oldest = self.events[0][0] - 1 if self.events else self.seq
+        if seq > self.seq or seq < oldest:
+            return None
+        return seq
+
+    def publish(self, op, payload=None):
+        """op: add (метка целиком, повторный add — обновление), remove (message_id), reset"""
+        with self._cond:
+            self.seq += 1
+            self.events.append((self.seq, op, payload))
+            self._cond.notify_all()
+            waiters, self._waiters = self._waiters, set()
+        for loop, fut in waiters:
+            loop.call_soon_threadsafe(lambda f=fut: f.done() or f.set_result(True))
+
+    def since(self, cursor):
+        """Дельта после курсора; None — изменений нет. При сбросе added — все текущие метки"""
+        with self._cond:
+            seq = self._parse(cursor)
+            if seq is None:
+                return {
+                    'cursor': self.cursor(),
+                    'reset': True,
+                    'added': list(location_store_ref[0].items) if location_store_ref else [],
+                    'removed': [],
+                }
+            if seq == self.seq:
+                return None
+            
+            start = len(self.events) - (self.seq - seq)
+            added, removed, reset = {}, set(), False
+            for _, op, payload in itertools.islice(self.events, start, None):
+                if op == 'reset':
+                    added, removed, reset = {}, set(), True
+                elif op == 'add':
+                    added[payload['message_id']] = payload
+                    removed.discard(payload['message_id'])
+                elif op == 'remove':
+                    added.pop(payload, None)
+                    removed.add(payload)
+            return {
+                'cursor': self.cursor(),
+                'reset': reset,
+                'added': list(added.values()),
+                'removed': sorted(removed),
+            }
+
+    def wait(self, cursor, timeout):
+        """Блокирует поток до нового события после курсора; False — вышел таймаут"""
+        with self._cond:
+            seq = self._parse(cursor)
+            if seq is None:
+                return True
+            return self._cond.wait_for(lambda: self.seq > seq, timeout)
+
+    async def wait_async(self, cursor, timeout):
+        """То же для корутин: ждёт без потока на каждого подписчика"""
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        with self._cond:
+            seq = self._parse(cursor)
+            if seq is None or self.seq > seq:
+                return True
+            self._waiters.add((loop, fut))
+        try:
+            await asyncio.wait_for(fut, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self._cond:
+                self._waiters.discard((loop, fut))
+
+location_feed = LocationFeed()
+
+class HotspotIndex:
+    """Сетка по активным точкам: повторный отчёт рядом находится за O(1) по 3x3 соседним ячейкам"""
+
+    def __init__(self, radius_m=DEDUP_RADIUS_M, window_min=DEDUP_WINDOW_MIN):
+        self.radius_m = radius_m
+        self.window = window_min * 60
+        self.cells = {}    # (cx, cy) -> {id(loc): [last_seen_ts, loc]}
+        self._cell_of = {}  # id(loc) -> (cx, cy)
+
+    def _cell(self, lat, lon):
+        # Локальная равнопромежуточная проекция в метрах; ячейка = радиус склейки
+        y = lat * 110574
+        x = lon * 111320 * cos(radians(lat))
+        return floor(x / self.radius_m), floor(y / self.radius_m)
+
+    def add(self, loc, seen_ts=None):
+        key = self._cell(loc['latitude'], loc['longitude'])
+        seen_ts = seen_ts or datetime.fromisoformat(loc.get('last_seen', loc['timestamp'])).timestamp()
+        self.cells.setdefault(key, {})[id(loc)] = [seen_ts, loc]
+        self._cell_of[id(loc)] = key
+
+    def discard(self, loc):
+        key = self._cell_of.pop(id(loc), None)
+        if key is not None:
+            cell = self.cells[key]
+            cell.pop(id(loc), None)
+            if not cell:
+                del self.cells[key]
+
+    def match(self, lat, lon, now_ts):
+        """Ближайшая активная точка в радиусе склейки или None"""
+        cx, cy = self._cell(lat, lon)
+        best, best_dist = None, None
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for seen_ts, loc in (self.cells.get((cx + dx, cy + dy)) or {}).values():
+                    if now_ts - seen_ts > self.window:
+                        continue
+                    dist = calculate_distance(lat, lon, loc['latitude'], loc['longitude']) * 1000
+                    if dist <= self.radius_m and (best_dist is None or dist < best_dist):
+                        best, best_dist = loc, dist
+        return best
+
+    def touch(self, loc, now_ts):
+        key = self._cell_of.get(id(loc))
+        if key is not None:
+            self.cells[key][id(loc)][0] = now_ts
+
+    def prune(self, now_ts):
+        """Забывает точки, по которым окно склейки уже закрылось"""
+        stale = [
+            entry[1] for cell in self.cells.values() for entry in cell.values()
+            if now_ts - entry[0] > self.window
+        ]
+        for loc in stale:
+            self.discard(loc)
+        return len(stale)
+
+    def rebuild(self, locations):
+        self.cells.clear()
+        self._cell_of.clear()
+        now_ts = time.time()
+        for loc in locations:
+            seen_ts = datetime.fromisoformat(loc.get('last_seen', loc['timestamp'])).timestamp()
+            if now_ts - seen_ts <= self.window:
+                self.add(loc, seen_ts)
+
+hotspot_index = HotspotIndex()
+
+class LocationStore:
+    """Кольцевой буфер меток: O(1) добавление, вытеснение по возрасту (TTL) и по лимиту"""
+
+    def __init__(self, items=(), maxlen=LOCATIONS_MAX, ttl_hours=LOCATIONS_TTL_HOURS):
+        self.ttl = timedelta(hours=ttl_hours)
+        self.items = deque(maxlen=maxlen)
+        # JSON каждой метки кодируем один раз: экспорт — это склейка готовых строк
+        self._encoded = deque(maxlen=maxlen)
+        # Журнал ('add' | 'remove', метка) для SQLitePersistence; None — не ведётся
+        self.journal = None
+        for loc in items:
+            self.append(loc)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    @staticmethod
+    def _encode(loc):
+        return json.dumps(loc, ensure_ascii=False)
+
+    def _removed(self, loc):
+        hotspot_index.discard(loc)
+        location_feed.publish('remove', loc.get('message_id'))
+        if self.journal is not None:
+            self.journal.append(('remove', loc))
+
+    def append(self, loc):
+        if len(self.items) == self.items.maxlen:
+            # deque сам вытеснит самую старую метку — карте и индексу точек нужно об этом сказать
+            self._removed(self.items[0])
+        self.items.append(loc)
+        self._encoded.append(self._encode(loc))
+        location_feed.publish('add', loc)
+        if self.journal is not None:
+            self.journal.append(('add', loc))
+
+    def touch(self, loc):
+        """Метка изменилась на месте (склейка отчётов): перекодировать и разослать"""
+        # Склеиваются только свежие метки, поэтому ищем с конца
+        for i in range(len(self.items) - 1, -1, -1):
+            if self.items[i] is loc:
+                self._encoded[i] = self._encode(loc)
+                location_feed.publish('add', loc)
+                return True
+        return False
+
+    def prune(self, now=None):
+        """Удаляет метки старше TTL; метки лежат по времени, так что смотрим только начало"""
+        cutoff = (now or datetime.now()) - self.ttl
+        removed = 0
+        while self.items and datetime.fromisoformat(self.items[0]['timestamp']) < cutoff:
+            loc = self.items.popleft()
+            self._encoded.popleft()
+            self._removed(loc)
+            removed += 1
+        return removed
+
+    def remove_where(self, predicate):
+        """Удаляет метки по условию (удаления с других воркеров); O(n), случается редко"""
+        items, encoded = deque(maxlen=self.items.maxlen), deque(maxlen=self.items.maxlen)
+        removed = 0
+        for loc, raw in zip(self.items, self._encoded):
+            if predicate(loc):
+                self._removed(loc)
+                removed += 1
+            else:
+                items.append(loc)
+                encoded.append(raw)
+        self.items, self._encoded = items, encoded
+        return removed
+
+    def clear(self):
+        if self.journal is not None:
+            self.journal.extend(('remove', loc) for loc in self.items)
+        self.items.clear()
+        self._encoded.clear()
+        hotspot_index.rebuild(())
+        location_feed.publish('reset')
+
+    def to_json(self):
+        if not self._encoded:
+            return "[]"
+        return "[\n    " + ",\n    ".join(self._encoded) + "\n  ]"
+
+def get_location_store(bot_data):
+    """bot_data['locations'] как LocationStore (из базы и старого pickle приходит список)"""
+    store = bot_data.get('locations')
+    if not isinstance(store, LocationStore):
+        store = bot_data['locations'] = LocationStore(store or ())
+        location_store_ref[:] = [store]
+    return store
+
+# Текущий LocationStore для метрик и HTTP (потоки Flask не видят context.bot_data)
+location_store_ref = []
+
+async def prune_locations_job(context: ContextTypes.DEFAULT_TYPE):
+    ingest_limiter.prune()
+    async with state_locks.collection('locations'):
+        hotspot_index.prune(time.time())
+        removed = get_location_store(context.bot_data).prune()
+        if removed:
+            log_event("locations_expired", removed=removed, left=len(get_location_store(context.bot_data)))
+            await save_data(context)
+
+# --- ФУНКЦИИ ---
+EARTH_RADIUS_KM = 6371
+REGION_CELL_DEG = 0.02  # ~2 км — в ячейку попадает 1-4 региона-кандидата
+
+def calculate_distance(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
+    dlat, dlon = lat2 - lat1, lon2 - lon1
+    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
+    return EARTH_RADIUS_KM * 2 * atan2(sqrt(a), sqrt(1-a))
+
+class RegionIndex:
+    """Сетка над REGIONS: для каждой ячейки заранее известны регионы, которые могут её накрыть"""
+
+    def __init__(self, regions, cell_deg=REGION_CELL_DEG):
+        self.cell_deg = cell_deg
+        self.cells = {}
+        self.ids = list(regions)
+        for r_id, r_data in regions.items():
+            lat, lon = r_data['coords']
+            radius = r_data['radius']
+            # Описанный вокруг круга прямоугольник в градусах
+            dlat = radius / 111.0
+            dlon = radius / (111.32 * cos(radians(lat)))
+            for i in range(floor((lat - dlat) / cell_deg), floor((lat + dlat) / cell_deg) + 1):
+                for j in range(floor((lon - dlon) / cell_deg), floor((lon + dlon) / cell_deg) + 1):
+                    self.cells.setdefault((i, j), []).append((r_id, lat, lon, radius))
+        
+        # Массивы для векторной классификации
+        if np is not None:
+            self._lat = np.radians([regions[r]['coords'][0] for r in self.ids])
+            self._lon = np.radians([regions[r]['coords'][1] for r in self.ids])
+            self._radius = np.array([regions[r]['radius'] for r in self.ids], dtype=float)
+
+    def lookup(self, latitude, longitude):
+        """Ближайший к центру регион, в радиус которого попадает точка: (r_id, dist) или (None, None)"""
+        candidates = self.cells.get((floor(latitude / self.cell_deg), floor(longitude / self.cell_deg)))
+        best, best_dist = None, None
+        for r_id, lat, lon, radius in candidates or ():
+            dist = calculate_distance(latitude, longitude, lat, lon)
+            if dist <= radius and (best_dist is None or dist < best_dist):
+                best, best_dist = r_id, dist
+        return best, best_dist
+
+    def classify(self, points, chunk=50000):
+        """Пакетная классификация [(lat, lon), ...] -> [r_id | None, ...] для бэкфилла и аналитики"""
+        if np is None:
+            return [self.lookup(lat, lon)[0] for lat, lon in points]
+        
+        result = []
+        ids = np.array(self.ids + [None], dtype=object)
+        for start in range(0, len(points), chunk):
+            pts = np.radians(np.asarray(points[start:start + chunk], dtype=float).reshape(-1, 2))
+            lat = pts[:, 0:1]
+            lon = pts[:, 1:2]
+            a = np.sin((self._lat - lat) / 2) ** 2 + np.cos(lat) * np.cos(self._lat) * np.sin((self._lon - lon) / 2) ** 2
+            dist = EARTH_RADIUS_KM * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+            dist[dist > self._radius] = np.inf
+            best = np.argmin(dist, axis=1)
+            best[np.isinf(dist[np.arange(len(best)), best])] = len(self.ids)
+            result.extend(ids[best].tolist())
+        return result
+
+region_index = RegionIndex(REGIONS)
+
+def get_location_region(latitude, longitude):
+    r_id, dist = region_index.lookup(latitude, longitude)
+    if r_id:
+        log_event("region_match", logging.DEBUG, region=r_id, dist_km=round(dist, 2))
+        return r_id
+    log_event("region_miss", logging.DEBUG, lat=latitude, lon=longitude)
+    return None
+
+class GeofenceIndex:
+    """Сетка над личными зонами: ячейка -> пользователи, чья зона её задевает; запрос точки — одна ячейка"""
+
+    def __init__(self, cell_deg=GEOFENCE_CELL_DEG):
+        self.cell_deg = cell_deg
+        self.cells = {}     # (i, j) -> {uid: (lat, lon, radius_km)}
+        self._zones = {}    # uid -> ячейки его зоны
+
+    def __len__(self):
+        return len(self._zones)
+
+    def _cells(self, lat, lon, radius):
+        # Как в RegionIndex: описанный вокруг круга прямоугольник в градусах
+        dlat = radius / 111.0
+        dlon = radius / (111.32 * cos(radians(lat)))
+        return [
+            (i, j)
+            for i in range(floor((lat - dlat) / self.cell_deg), floor((lat + dlat) / self.cell_deg) + 1)
+            for j in range(floor((lon - dlon) / self.cell_deg), floor((lon + dlon) / self.cell_deg) + 1)
+        ]
+
+    def update(self, uid, zone):
+        self.remove(uid)
+        if not zone:
+            return
+        entry = (zone['lat'], zone['lon'], zone['radius'])
+        cells = self._cells(*entry)
+        for cell in cells:
+            self.cells.setdefault(cell, {})[uid] = entry
+        self._zones[uid] = cells
+
+    def remove(self, uid):
+        for cell in self._zones.pop(uid, ()):
+            members = self.cells[cell]
+            del members[uid]
+            if not members:
+                del self.cells[cell]
+
+    def clear(self):
+        self.cells.clear()
+        self._zones.clear()
+
+    def match(self, latitude, longitude):
+        """Пользователи, в чью зону попадает точка"""
+        candidates = self.cells.get((floor(latitude / self.cell_deg), floor(longitude / self.cell_deg)))
+        return {
+            uid for uid, (lat, lon, radius) in (candidates or {}).items()
+            if calculate_distance(latitude, longitude, lat, lon) <= radius
+        }
+
+class Subscriber:
+    """Настройки пользователя: __slots__ вместо dict, регионы — маска по REGION_ORDER.
+    Снаружи читается и пишется как прежний dict (get/[]/pop, ключ 'regions' — список)"""
+
+    __slots__ = ('mask', 'notifications', 'delivery', 'digest_min', 'quiet', 'zone')
+    OPTIONAL = ('delivery', 'digest_min', 'quiet', 'zone')
+    # Ключи строки в базе: {"m":5,"n":1} вместо {"regions":[...],"notifications":true}
+    SHORT = {'delivery': 'd', 'digest_min': 'dm', 'quiet': 'q', 'zone': 'z'}
+
+    def __init__(self, mask=0, notifications=False, delivery=None, digest_min=None, quiet=None, zone=None):
+        self.mask = mask
+        self.notifications = notifications
+        self.delivery = delivery
+        self.digest_min = digest_min
+        self.quiet = quiet
+        self.zone = zone
+
+    def __getitem__(self, key):
+        if key == 'regions':
+            return mask_regions(self.mask)
+        if key not in self.__slots__ or key == 'mask' or getattr(self, key) is None:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key == 'regions':
+            self.mask = region_mask(value)
+        elif key == 'notifications' or key in self.OPTIONAL:
+            setattr(self, key, value)
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, default=None):
+        value = self.get(key, default)
+        if key in self.OPTIONAL:
+            setattr(self, key, None)
+        return value
+
+    def dumps(self):
+        data = {'m': self.mask, 'n': int(bool(self.notifications))}
+        for field in self.OPTIONAL:
+            value = getattr(self, field)
+            if value is not None:
+                data[self.SHORT[field]] = value
+        return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+
+    @classmethod
+    def loads(cls, raw, order=REGION_ORDER):
+        """Строка из базы; order — порядок битов, с которым она записана"""
+        data = json.loads(raw)
+        if 'm' not in data:
+            return cls.from_dict(data)
+        mask = data['m'] if order == REGION_ORDER else region_mask(mask_regions(data['m'], order))
+        return cls(mask, bool(data['n']), *(data.get(cls.SHORT[field]) for field in cls.OPTIONAL))
+
+    @classmethod
+    def from_dict(cls, data):
+        """Прежний формат: dict из pickle, старых строк базы или bench.py"""
+        return cls(
+            region_mask(data.get('regions', ())), bool(data.get('notifications')),
+            *(data.get(field) for field in cls.OPTIONAL)
+        )
+
+    @classmethod
+    def of(cls, value):
+        return value if isinstance(value, cls) else cls.from_dict(value)
+
+class SubscriberIndex:
+    """Подписки колонками array: uid, маска регионов, флаг уведомлений — 17 байт на пользователя.
+    Получатели метки — векторный AND по всем маскам (numpy поверх тех же буферов), плюс личные зоны"""
+
+    def __init__(self):
+        self.uids = array('q')
+        self.masks = array('Q')
+        self.active = array('B')
+        self._row = {}      # uid -> номер строки в колонках
+        self.zones = GeofenceIndex()
+        # Зарегистрированные по регионам (включая выключивших уведомления) и с уведомлениями — для статистики.
+        # Пишет event loop, читает ещё и поток Flask (/stats.json) — отсюда замок
+        self._lock = threading.Lock()
+        self.registered = {}
+        self.notified = {}
+
+    def __len__(self):
+        return len(self.uids)
+
+    def _count(self, mask, active, sign):
+        with self._lock:
+            for rid in mask_regions(mask):
+                self.registered[rid] = self.registered.get(rid, 0) + sign
+                if not self.registered[rid]:
+                    del self.registered[rid]
+                if active:
+                    self.notified[rid] = self.notified.get(rid, 0) + sign
+                    if not self.notified[rid]:
+                        del self.notified[rid]
+
+    def update(self, uid, udata):
+        """Пересчитывает подписки одного пользователя после изменения настроек"""
+        sub = Subscriber.of(udata)
+        row = self._row.get(uid)
+        if row is None:
+            row = self._row[uid] = len(self.uids)
+            self.uids.append(uid)
+            self.masks.append(0)
+            self.active.append(0)
+        else:
+            self._count(self.masks[row], self.active[row], -1)
+        active = bool(sub.notifications)
+        self.masks[row] = sub.mask
+        self.active[row] = active
+        self._count(sub.mask, active, 1)
+        self.zones.update(uid, sub.zone if active else None)
+
+    def remove(self, uid):
+        row = self._row.pop(uid, None)
+        if row is None:
+            return
+        self._count(self.masks[row], self.active[row], -1)
+        last = len(self.uids) - 1
+        if row != last:
+            # Последняя строка встаёт на место удалённой — колонки без дыр
+            moved = self.uids[last]
+            self.uids[row], self.masks[row], self.active[row] = moved, self.masks[last], self.active[last]
+            self._row[moved] = row
+        self.uids.pop()
+        self.masks.pop()
+        self.active.pop()
+        self.zones.remove(uid)
+
+    def rebuild(self, users):
+        self.uids, self.masks, self.active = array('q'), array('Q'), array('B')
+        self._row.clear()
+        with self._lock:
+            self.registered.clear()
+            self.notified.clear()
+        self.zones.clear()
+        for uid, udata in users.items():
+            self.update(uid, udata)
+
+    def recipients(self, rid):
+        bit = REGION_BITS.get(rid)
+        if not bit or not self.uids:
+            return []
+        if np is None:
+            return [uid for uid, mask, on in zip(self.uids, self.masks, self.active) if on and mask & bit]
+        hit = np.frombuffer(self.masks, dtype=np.uint64) & np.uint64(bit) != 0
+        hit &= np.frombuffer(self.active, dtype=np.bool_)
+        return np.frombuffer(self.uids, dtype=np.int64)[hit].tolist()
+
+    def counts(self):
+        """регион -> (зарегистрировано, с уведомлениями); без обхода пользователей, из любого потока"""
+        with self._lock:
+            return {rid: (registered, self.notified.get(rid, 0)) for rid, registered in self.registered.items()}
+
+subscriber_index = SubscriberIndex()
+
+def local_now():
+    return datetime.now(LOCAL_TZ)
+
+def local_today():
+    return local_now().date()
+
+class FineStats:
+    """Скользящие за STATS_DAYS дней гистограммы меток: регион × час / день недели и сетка тепловой карты"""
+
+    def __init__(self, days=STATS_DAYS, cell_deg=HEATMAP_CELL_DEG):
+        self.days = days
+        self.cell_deg = cell_deg
+        self._lock = threading.Lock()
+        # Прибавки к строкам stats_hours / stats_cells с прошлого сброса: {(day, rid, hour): n}, {(day, i, j): n}
+        self._hours_delta, self._cells_delta = {}, {}
+        self.load()
+
+    def load(self, hour_rows=(), cell_rows=()):
+        """Корзины из строк базы (day, region, hour, n) и (day, i, j, n); итоги окна пересчитываются из них"""
+        with self._lock:
+            self.buckets = {}
+            for day, rid, hour, n in hour_rows:
+                bucket = self.buckets.setdefault(day, {'hours': {}, 'cells': {}})
+                bucket['hours'].setdefault(rid, [0] * 24)[hour] += n
+            for day, i, j, n in cell_rows:
+                bucket = self.buckets.setdefault(day, {'hours': {}, 'cells': {}})
+                bucket['cells'][(i, j)] = bucket['cells'].get((i, j), 0) + n
+            self.by_hour, self.by_dow, self.cells = {}, {}, {}
+            for day, bucket in self.buckets.items():
+                self._apply(day, bucket, 1)
+            self._evict(local_today())
+            self._payload = None
+
+    def _apply(self, day, bucket, sign):
+        """Прибавляет (sign=1) или вычитает (sign=-1) дневную корзину из итогов"""
+        dow = date.fromisoformat(day).weekday()
+        for rid, hours in bucket['hours'].items():
+            by_hour = self.by_hour.setdefault(rid, [0] * 24)
+            for hour, n in enumerate(hours):
+                by_hour[hour] += sign * n
+            self.by_dow.setdefault(rid, [0] * 7)[dow] += sign * sum(hours)
+        for cell, n in bucket['cells'].items():
+            left = self.cells.get(cell, 0) + sign * n
+            if left:
+                self.cells[cell] = left
+            else:
+                self.cells.pop(cell, None)
+
+    def cutoff(self, today=None):
+        """Первый день окна (ISO); строки раньше него из базы удаляются"""
+        return ((today or local_today()) - timedelta(days=self.days - 1)).isoformat()
+
+    def _evict(self, today):
+        # Корзина выпадает из окна целиком — раз в сутки, а не на каждой метке
+        self._evicted_on = today
+        cutoff = self.cutoff(today)
+        for day in [d for d in self.buckets if d < cutoff]:
+            self._apply(day, self.buckets.pop(day), -1)
+
+    def record(self, loc, rid=None, persist=True):
+        """O(1): метка в дневную корзину и в итоги окна; False — метка старше окна.
+
+        persist=False — метку уже учёл в базе другой воркер (пришла через _pull)."""
+        # Метки хранят время сервера без пояса — для корзин переводим в LOCAL_TZ
+        ts = datetime.fromisoformat(loc['timestamp']).astimezone(LOCAL_TZ)
+        rid = rid or get_location_region(loc['latitude'], loc['longitude']) or 'other'
+        cell = (floor(loc['latitude'] / self.cell_deg), floor(loc['longitude'] / self.cell_deg))
+        day = ts.date().isoformat()
+        
+        with self._lock:
+            today = local_today()
+            if today != self._evicted_on:
+                self._evict(today)
+            if day < self.cutoff(today):
+                return False
+            
+            bucket = self.buckets.setdefault(day, {'hours': {}, 'cells': {}})
+            bucket['hours'].setdefault(rid, [0] * 24)[ts.hour] += 1
+            bucket['cells'][cell] = bucket['cells'].get(cell, 0) + 1
+            self.by_hour.setdefault(rid, [0] * 24)[ts.hour] += 1
+            self.by_dow.setdefault(rid, [0] * 7)[ts.weekday()] += 1
+            self.cells[cell] = self.cells.get(cell, 0) + 1
+            if persist:
+                key = (day, rid, ts.hour)
+                self._hours_delta[key] = self._hours_delta.get(key, 0) + 1
+                key = (day, *cell)
+                self._cells_delta[key] = self._cells_delta.get(key, 0) + 1
+            self._payload = None
+            return True
+
+    def drain(self):
+        """Накопленные прибавки строками (..., n) для UPSERT; счётчики обнуляются"""
+        with self._lock:
+            hours, self._hours_delta = self._hours_delta, {}
+            cells, self._cells_delta = self._cells_delta, {}
+        return [(*key, n) for key, n in hours.items()], [(*key, n) for key, n in cells.items()]
+
+    def restore(self, hour_rows, cell_rows):
+        """Вернуть прибавки после неудачной записи — уйдут следующим сбросом"""
+        with self._lock:
+            for *key, n in hour_rows:
+                self._hours_delta[tuple(key)] = self._hours_delta.get(tuple(key), 0) + n
+            for *key, n in cell_rows:
+                self._cells_delta[tuple(key)] = self._cells_delta.get(tuple(key), 0) + n
+
+    def payload(self):
+        """Готовые итоги окна; пересобираются только после новых меток или смены суток"""
+        with self._lock:
+            today = local_today()
+            if today != self._evicted_on:
+                self._evict(today)
+                self._payload = None
+            if self._payload is None:
+                half = self.cell_deg / 2
+                self._payload = {
+                    'window_days': self.days,
+                    'fines': {
+                        rid: {
+                            'total': sum(hours),
+                            'by_hour': list(hours),
+                            'by_dow': list(self.by_dow.get(rid, [0] * 7)),
+                        }
+                        for rid, hours in self.by_hour.items() if sum(hours)
+                    },
+                    'heatmap': {
+                        'cell_deg': self.cell_deg,
+                        'cells': [
+                            [round(i * self.cell_deg + half, 5), round(j * self.cell_deg + half, 5), n]
+                            for (i, j), n in self.cells.items()
+                        ],
+                    },
+                }
+            return self._payload
+
+fine_stats = FineStats()
+
+def stats_payload():
+    """JSON для /stats.json: подписчики из индекса и гистограммы меток — всё уже посчитано"""
+    return {
+        'generated_at': datetime.now().isoformat(timespec='seconds'),
+        'subscribers': {
+            rid: {'name': REGIONS[rid]['name'], 'registered': registered, 'notifications': active}
+            for rid, (registered, active) in subscriber_index.counts().items() if rid in REGIONS
+        },
+        **fine_stats.payload(),
+    }
+
+class GitHubClient:
+    """Клиент contents API: помнит sha/ETag файла и хэш последнего залитого содержимого"""
+
+    def __init__(self, path=GITHUB_FILE):
+        self.path = path
+        self.url = f"{GITHUB_API_URL}/repos/{GITHUB_USERNAME}/{GITHUB_REPO}/contents/{path}"
+        self.session = requests.Session()
+        self.sha = None
+        self.etag = None
+        self.content_hash = None
+        self.sha_known = False   # sha = None после 404 тоже валидное знание
+        self.api_calls = 0
+        self.skipped = 0
+
+    def _headers(self):
+        return {
+            "Authorization": f"token {GITHUB_TOKEN}",
+            "Accept": "application/vnd.github.v3+json"
+        }
+
+    def fetch_sha(self):
+        """Условный GET: при 304 закэшированный sha ещё актуален"""
+        headers = self._headers()
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        
+        res = self.session.get(self.url, headers=headers, timeout=10)
+        self.api_calls += 1
+        metrics.inc("wolt_github_api_calls_total", method="GET")
+        log_event("github_get", logging.DEBUG, path=self.path, status=res.status_code)
+        
+        if res.status_code == 304:
+            pass
+        elif res.status_code == 200:
+            self.sha = res.json().get("sha")
+            self.etag = res.headers.get("ETag")
+            # Содержимое на GitHub могли поменять руками — хэшу больше не верим
+            self.content_hash = None
+        elif res.status_code == 404:
+            self.sha = self.etag = self.content_hash = None
+            log_event("github_file_missing", logging.WARNING, path=self.path)
+        else:
+            log_event("github_get_failed", logging.ERROR, path=self.path, status=res.status_code, body=res.text[:200])
+            return False
+        
+        self.sha_known = True
+        return True
+
+    def _put(self, content):
+        payload = {
+            "message": f"Update: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
+            "content": b64encode(content.encode()).decode(),
+        }
+        if self.sha:
+            payload["sha"] = self.sha
+        
+        res = self.session.put(self.url, headers=self._headers(), json=payload, timeout=10)
+        self.api_calls += 1
+        metrics.inc("wolt_github_api_calls_total", method="PUT")
+        log_event("github_put", logging.DEBUG, path=self.path, status=res.status_code)
+        return res
+
+    def upload(self, content, digest):
+        """content — готовый текст файла, digest — хэш его значимой части (без updated_at)"""
+        if digest == self.content_hash:
+            self.skipped += 1
+            log_event("github_skip_unchanged", logging.DEBUG, path=self.path)
+            return True
+        
+        if not self.sha_known and not self.fetch_sha():
+            return False
+        
+        res = self._put(content)
+        
+        # 409/422 — sha устарел (файл меняли мимо нас): перечитываем и пробуем ещё раз
+        if res.status_code in [409, 422]:
+            log_event("github_sha_conflict", logging.WARNING, path=self.path, status=res.status_code)
+            if not self.fetch_sha():
+                return False
+            res = self._put(content)
+        
+        if res.status_code in [200, 201]:
+            self.sha = res.json().get("content", {}).get("sha")
+            self.etag = None
+            self.content_hash = digest
+            return True
+        
+        log_event("github_put_failed", logging.ERROR, path=self.path, status=res.status_code, body=res.text[:200])
+        self.sha_known = False
+        return False
+
+github_client = GitHubClient()
+
+def upload_to_github(snapshot):
+    try:
+        ok = github_client.upload(snapshot['content'], snapshot['hash'])
+        log_event(
+            "github_upload", logging.INFO if ok else logging.WARNING,
+            ok=ok, locations=snapshot['total_count'],
+            api_calls=github_client.api_calls, skipped=github_client.skipped
+        )
+        return ok
+        
+    except Exception as e:
+        # После сетевой ошибки не знаем, дошёл ли PUT — sha перечитаем
+        github_client.sha_known = False
+        log_event("github_upload_error", logging.ERROR, exc_info=True, error=str(e))
+        return False
+
+class GitHubPublisher:
+    """Фоновая публикация locations.json: пачка изменений за окно = один коммит"""
+
+    def __init__(self, window=PUBLISH_WINDOW, max_retries=PUBLISH_MAX_RETRIES, backoff=PUBLISH_BACKOFF):
+        self.window = window
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._pending = None          # последний снапшот, ждущий публикации
+        self._pending_count = 0       # сколько сохранений склеено в него
+        self._first_enqueued = None   # когда в пачку попало первое изменение
+        self._event = None
+        self._task = None
+        self.published = 0
+        self.failures = 0
+        self.last_latency = None
+        self.last_published_at = None
+
+    @property
+    def queue_depth(self):
+        return self._pending_count
+
+    def enqueue(self, data):
+        """Ставит снапшот в очередь; вызывается из хендлеров, не блокирует"""
+        if self._pending is None:
+            self._first_enqueued = time.monotonic()
+        self._pending = data
+        self._pending_count += 1
+        if self._event:
+            self._event.set()
+
+    def start(self):
+        self._event = asyncio.Event()
+        if self._pending is not None:
+            self._event.set()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает фоновую задачу и публикует то, что осталось в очереди"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._pending is not None:
+            await self._publish_pending()
+
+    def stats(self):
+        return {
+            'queue_depth': self.queue_depth,
+            'published': self.published,
+            'failures': self.failures,
+            'last_latency': round(self.last_latency, 3) if self.last_latency is not None else None,
+            'last_published_at': self.last_published_at,
+        }
+
+    async def _run(self):
+        while True:
+            await self._event.wait()
+            # Ждём окно, чтобы склеить всплеск меток в один коммит
+            await asyncio.sleep(self.window)
+            self._event.clear()
+            await self._publish_pending()
+
+    async def _publish_pending(self):
+        if self._pending is None:
+            return True
+        
+        data = None
+        try:
+            for attempt in range(self.max_retries + 1):
+                # Если за время ретрая пришёл более свежий снапшот — публикуем его
+                if self._pending is not None:
+                    data, count, enqueued = self._pending, self._pending_count, self._first_enqueued
+                    self._pending, self._pending_count, self._first_enqueued = None, 0, None
+                
+                started = time.perf_counter()
+                ok = await asyncio.to_thread(upload_to_github, data)
+                metrics.observe("wolt_github_publish_seconds", time.perf_counter() - started)
+                
+                if ok:
+                    self.published += 1
+                    self.last_latency = time.monotonic() - enqueued
+                    self.last_published_at = datetime.now().isoformat()
+                    log_event("publish_done", changes=count, latency=round(self.last_latency, 3))
+                    return True
+                
+                metrics.inc("wolt_github_publish_failures_total")
+                if attempt < self.max_retries:
+                    delay = self.backoff * 2 ** attempt
+                    log_event("publish_retry", logging.WARNING, attempt=attempt + 1, delay=delay)
+                    await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            # stop() посреди попытки или паузы: снапшот возвращаем в очередь, его опубликует stop()
+            if data is not None:
+                if self._pending is None:
+                    self._pending, self._first_enqueued = data, enqueued
+                else:
+                    self._first_enqueued = enqueued
+                self._pending_count += count
+            raise
+        
+        self.failures += 1
+        log_event("publish_failed", logging.ERROR, attempts=self.max_retries + 1)
+        return False
+
+publisher = GitHubPublisher()
+
+class LocationSnapshot:
+    """Готовый к отдаче снимок меток (locations.json или компактный): сильный ETag и сжатые варианты, считаются раз на версию"""
+
+    # Сжатие лениво, в потоке HTTP-запроса: event loop бота его не ждёт
+    ENCODINGS = [('gzip', lambda raw: gzip.compress(raw, compresslevel=6))]
+    if brotli:
+        ENCODINGS.insert(0, ('br', lambda raw: brotli.compress(raw, quality=5)))
+
+    def __init__(self, empty=b'{"locations": [], "total_count": 0}'):
+        self._lock = threading.Lock()
+        self._version = (empty, '"empty"', {})
+
+    @staticmethod
+    def _etag(raw):
+        return f'"{hashlib.sha256(raw).hexdigest()[:32]}"'
+
+    def update(self, content):
+        raw = content.encode()
+        # Кортеж подменяется целиком — читатели из других потоков видят либо старую, либо новую версию
+        self._version = (raw, self._etag(raw), {})
+
+    def update_lazy(self, build):
+        """Версия, тело которой build() соберёт первый запрос — в потоке HTTP, а не в event loop"""
+        self._version = (None, None, {'build': build})
+
+    def _ready(self, version):
+        raw, etag, cache = version
+        if raw is not None:
+            return version
+        with self._lock:
+            if 'raw' not in cache:
+                cache['raw'] = cache['build']().encode()
+                cache['etag'] = self._etag(cache['raw'])
+                del cache['build']
+        return cache['raw'], cache['etag'], cache
+
+    def _encoded(self, version, accept_encoding):
+        raw, _, cache = version
+        for name, compress in self.ENCODINGS:
+            if name in accept_encoding:
+                if name not in cache:
+                    with self._lock:
+                        if name not in cache:
+                            cache[name] = compress(raw)
+                return name, cache[name]
+        return None, raw
+
+    def serve(self, if_none_match, accept_encoding):
+        """HTTP-ответ (status, headers, body) без привязки к веб-фреймворку"""
+        version = self._ready(self._version)
+        etag = version[1]
+        headers = {
+            'ETag': etag,
+            'Cache-Control': 'no-cache',
+            'Vary': 'Accept-Encoding',
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Expose-Headers': 'ETag',
+        }
+        if if_none_match and etag in [t.strip() for t in if_none_match.split(',')]:
+            return 304, headers, b''
+        
+        encoding, body = self._encoded(version, accept_encoding or '')
+        headers['Content-Type'] = 'application/json; charset=utf-8'
+        if encoding:
+            headers['Content-Encoding'] = encoding
+        return 200, headers, body
+
+location_snapshot = LocationSnapshot()
+compact_snapshot = LocationSnapshot(empty=b'{"v": 1, "count": 0}')
+
+def encode_compact(locs, cursor=None):
+    """Колонки вместо объектов: координаты целыми в 1/COMPACT_SCALE°, время — секунды от t0, имена — словарём"""
+    epoch = lambda iso: int(datetime.fromisoformat(iso).timestamp())
+    ts = [epoch(loc['timestamp']) for loc in locs]
+    t0 = min(ts) if ts else 0
+    users, user_col = {}, []
+    for loc in locs:
+        user_col.append(users.setdefault(loc.get('user') or '', len(users)))
+    
+    return {
+        'v': 1,
+        'count': len(locs),
+        'cursor': cursor,
+        'scale': COMPACT_SCALE,
+        't0': t0,
+        'id': [loc['message_id'] for loc in locs],
+        'lat': [round(loc['latitude'] * COMPACT_SCALE) for loc in locs],
+        'lon': [round(loc['longitude'] * COMPACT_SCALE) for loc in locs],
+        'ts': [t - t0 for t in ts],
+        'users': list(users),
+        'user': user_col,
+        'reports': [loc.get('report_count', 1) for loc in locs],
+        'seen': [epoch(loc.get('last_seen') or loc['timestamp']) - t0 for loc in locs],
+    }
+
+def compact_body(locs, cursor):
+    return json.dumps(encode_compact(locs, cursor), ensure_ascii=False, separators=(',', ':'))
+
+def build_snapshot(store):
+    body = store.to_json()
+    return {
+        'content': (
+            f'{{\n  "locations": {body},\n'
+            f'  "updated_at": "{datetime.now().isoformat()}",\n'
+            f'  "total_count": {len(store)}\n}}\n'
+        ),
+        # Курсор ленты берём в тот же момент, что и метки: карта догонит изменения дельтами с него.
+        # Сами колонки (разбор всех timestamp) — лениво, раз на версию в потоке HTTP-запроса
+        'compact': functools.partial(compact_body, list(store.items), location_feed.cursor()),
+        'hash': hashlib.sha256(body.encode()).hexdigest(),
+        'total_count': len(store),
+    }
+
+def update_snapshots(snapshot):
+    location_snapshot.update(snapshot['content'])
+    compact_snapshot.update_lazy(snapshot['compact'])
+
+async def save_data(context):
+    store = get_location_store(context.bot_data)
+    snapshot = build_snapshot(store)
+    update_snapshots(snapshot)
+    
+    # В кластере GitHub пишет только лидер, остальные лишь обновляют свой снимок для /locations.json
+    if GITHUB_MIRROR and cluster.is_leader:
+        log_event("publish_queued", logging.DEBUG, locations=len(store), queue=publisher.queue_depth + 1)
+        publisher.enqueue(snapshot)
+
+# --- ПЕРСИСТЕНТНОСТЬ ---
+class _PickleLoader(pickle.Unpickler):
+    """Читает файл PicklePersistence без объекта Bot (в bot_data ботов нет)"""
+
+    def persistent_load(self, pid):
+        return None
+
+class SQLitePersistence(BasePersistence):
+    """bot_data в SQLite (WAL): при сбросе пишутся только изменившиеся строки"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY, data TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS admins (id INTEGER PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS locations (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            key TEXT NOT NULL UNIQUE,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value BLOB NOT NULL);
+        CREATE TABLE IF NOT EXISTS tombstones (
+            tbl TEXT NOT NULL,
+            key TEXT NOT NULL,
+            rev INTEGER NOT NULL,
+            worker TEXT,
+            deleted_at REAL NOT NULL,
+            PRIMARY KEY (tbl, key)
+        );
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+        CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, holder TEXT NOT NULL, expires_at REAL NOT NULL);
+        CREATE TABLE IF NOT EXISTS fanout (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            data TEXT NOT NULL,
+            created_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS routed (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            target INTEGER NOT NULL,
+            data TEXT NOT NULL,
+            created_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS routed_target ON routed (target, id);
+        CREATE TABLE IF NOT EXISTS stats_hours (
+            day TEXT NOT NULL,
+            region TEXT NOT NULL,
+            hour INTEGER NOT NULL,
+            n INTEGER NOT NULL,
+            PRIMARY KEY (day, region, hour)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS stats_cells (
+            day TEXT NOT NULL,
+            i INTEGER NOT NULL,
+            j INTEGER NOT NULL,
+            n INTEGER NOT NULL,
+            PRIMARY KEY (day, i, j)
+        ) WITHOUT ROWID;
+    """
+    ROW_KEYS = ('users', 'admins', 'locations')
+    # Каждая запись помечена ревизией и воркером: остальные воркеры дочитывают только новое
+    REV_TABLES = ('users', 'admins', 'locations', 'kv')
+
+    def __init__(self, filepath=DB_FILE, update_interval=PERSISTENCE_INTERVAL, worker_id=WORKER_ID):
+        # bot_data грузим и сохраняем сами: иначе PTB делает deepcopy всего состояния на каждый сброс
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=False, callback_data=False),
+            update_interval=update_interval
+        )
+        self.filepath = filepath
+        self.worker_id = worker_id
+        self.db = sqlite3.connect(filepath, check_same_thread=False, isolation_level=None, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(self.SCHEMA)
+        self._upgrade()
+        self._lock = threading.Lock()
+        self._task = None
+        self.bot_data = None
+        self._dirty_users = set()
+        self._dirty_locations = set()
+        self._dirty_kv = set()
+        self._saved_admins = set()
+        self._saved_locations = set()
+        self._saved_kv = set()
+        # Хранилище, чей журнал читает _collect; другой объект (старт, бэкфилл) — один полный проход
+        self._store = None
+        self.synced_rev = 0
+        self.last_flush_time = None
+
+    def _upgrade(self):
+        """Базы до появления ревизий: добавить колонки rev/worker и индексы по ним"""
+        for table in self.REV_TABLES:
+            columns = {row[1] for row in self.db.execute(f"PRAGMA table_info({table})")}
+            if 'rev' not in columns:
+                self.db.execute(f"ALTER TABLE {table} ADD COLUMN rev INTEGER NOT NULL DEFAULT 0")
+            if 'worker' not in columns:
+                self.db.execute(f"ALTER TABLE {table} ADD COLUMN worker TEXT")
+            self.db.execute(f"CREATE INDEX IF NOT EXISTS {table}_rev ON {table} (rev)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS tombstones_rev ON tombstones (rev)")
+        
+        # Гистограммы прежних версий — pickle-словарь в kv fine_stats:N (копия на каждую долю): переносим в строки
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            legacy = self.db.execute("SELECT value FROM kv WHERE key GLOB 'fine_stats:*' ORDER BY key LIMIT 1").fetchone()
+            if legacy and not self.db.execute("SELECT 1 FROM stats_hours LIMIT 1").fetchone():
+                days = pickle.loads(legacy[0]).get('days', {})
+                self.db.executemany(
+                    "INSERT INTO stats_hours (day, region, hour, n) VALUES (?, ?, ?, ?)",
+                    [(day, rid, hour, n) for day, bucket in days.items()
+                     for rid, hours in bucket['hours'].items() for hour, n in enumerate(hours) if n]
+                )
+                self.db.executemany(
+                    "INSERT INTO stats_cells (day, i, j, n) VALUES (?, ?, ?, ?)",
+                    [(day, i, j, n) for day, bucket in days.items() for (i, j), n in bucket['cells'].items()]
+                )
+            self.db.execute("DELETE FROM kv WHERE key GLOB 'fine_stats:*'")
+            self.db.execute("COMMIT")
+        except Exception:
+            self.db.execute("ROLLBACK")
+            raise
+
+    def _current_rev(self, cur):
+        row = cur.execute("SELECT value FROM meta WHERE key = 'rev'").fetchone()
+        return row[0] if row else 0
+
+    @staticmethod
+    def location_key(loc):
+        return f"{loc.get('message_id')}:{loc.get('timestamp')}"
+
+    def load(self):
+        """Читает bot_data из базы; заодно запоминает, что уже записано"""
+        with self._lock:
+            cur = self.db.cursor()
+            cur.execute("BEGIN")
+            try:
+                rev = self._current_rev(cur)
+                user_rows = cur.execute("SELECT id, data FROM users").fetchall()
+                admins = {row[0] for row in cur.execute("SELECT id FROM admins")}
+                loc_rows = cur.execute("SELECT key, data FROM locations ORDER BY seq").fetchall()
+                kv_rows = cur.execute("SELECT key, value FROM kv").fetchall()
+                # Гистограммы — в той же транзакции, что и метки: пришедшие позже _pull допишет сам
+                cutoff = (fine_stats.cutoff(),)
+                hour_rows = cur.execute("SELECT day, region, hour, n FROM stats_hours WHERE day >= ?", cutoff).fetchall()
+                cell_rows = cur.execute("SELECT day, i, j, n FROM stats_cells WHERE day >= ?", cutoff).fetchall()
+            finally:
+                cur.execute("COMMIT")
+        
+        fine_stats.load(hour_rows, cell_rows)
+        data = {key: pickle.loads(value) for key, value in kv_rows}
+        # Маски записаны в порядке регионов из базы; строки старого формата и перекодированные перепишем сбросом
+        order = tuple(data.get('region_bits') or REGION_ORDER)
+        if data.get('region_bits') != list(REGION_ORDER):
+            data['region_bits'] = list(REGION_ORDER)
+            self._dirty_kv.add('region_bits')
+        data['users'] = {uid: Subscriber.loads(raw, order) for uid, raw in user_rows}
+        self._dirty_users = {
+            uid for uid, raw in user_rows if order != REGION_ORDER or not raw.startswith('{"m":')
+        }
+        data['admins'] = admins
+        data['locations'] = [json.loads(raw) for _, raw in loc_rows]
+        
+        self._saved_admins = set(admins)
+        self._saved_locations = {key for key, _ in loc_rows}
+        self._saved_kv = {key for key, _ in kv_rows}
+        self._store = None
+        # Общие словари черновиков прежних версий build_state выбросит — удалим их и из базы
+        self._dirty_kv |= data.keys() & {'temp_regions', 'zone_pending'}
+        self.synced_rev = rev
+        return data
+
+    def attach(self, bot_data):
+        self.bot_data = bot_data
+
+    def mark_user(self, uid):
+        self._dirty_users.add(uid)
+
+    def mark_location(self, loc):
+        self._dirty_locations.add(self.location_key(loc))
+
+    def mark_kv(self, key):
+        """Ключ bot_data вне users/admins/locations изменён или удалён"""
+        self._dirty_kv.add(key)
+
+    def _location_changes(self, bot_data):
+        """Добавленные (key -> метка) и удалённые ключи меток: по журналу хранилища, без обхода всех меток"""
+        store = get_location_store(bot_data)
+        if store is not self._store or store.journal is None:
+            locations = {self.location_key(loc): loc for loc in store}
+            added = {key: loc for key, loc in locations.items() if key not in self._saved_locations}
+            deleted = self._saved_locations - locations.keys()
+            self._store, store.journal = store, []
+            return added, deleted
+        
+        journal, store.journal = store.journal, []
+        added, deleted = {}, set()
+        for op, loc in journal:
+            key = self.location_key(loc)
+            if op == 'add':
+                added[key] = loc
+                deleted.discard(key)
+            else:
+                added.pop(key, None)
+                deleted.add(key)
+        return {key: loc for key, loc in added.items() if key not in self._saved_locations}, deleted & self._saved_locations
+
+    def _collect(self):
+        """Собирает изменения с прошлого сброса; работает в потоке event loop.
+        Стоимость — по числу изменений: строки помечают mark_*, метки — журнал LocationStore"""
+        bot_data = self.bot_data
+        users = bot_data.get('users', {})
+        dirty, self._dirty_users = self._dirty_users, set()
+        dirty_locations, self._dirty_locations = self._dirty_locations, set()
+        dirty_kv, self._dirty_kv = self._dirty_kv, set()
+        
+        admins = set(bot_data.get('admins', set()))
+        locations_added, locations_deleted = self._location_changes(bot_data)
+        self._saved_locations |= locations_added.keys()
+        self._saved_locations -= locations_deleted
+        by_key = {}
+        if dirty_locations:
+            # Склейка отчётов трогает только свежие метки — ищем с конца
+            for loc in reversed(get_location_store(bot_data).items):
+                key = self.location_key(loc)
+                if key in dirty_locations:
+                    by_key[key] = loc
+                    if len(by_key) == len(dirty_locations):
+                        break
+        stats_hours, stats_cells = fine_stats.drain()
+        
+        changes = {
+            'users_upsert': [(uid, Subscriber.of(users[uid]).dumps()) for uid in dirty if uid in users],
+            'users_delete': [(uid,) for uid in dirty if uid not in users],
+            'admins_add': [(a,) for a in admins - self._saved_admins],
+            'admins_delete': [(a,) for a in self._saved_admins - admins],
+            'locations_add': [(key, json.dumps(loc, ensure_ascii=False)) for key, loc in locations_added.items()],
+            'locations_delete': [(key,) for key in locations_deleted],
+            'locations_update': [
+                (json.dumps(loc, ensure_ascii=False), key)
+                for key, loc in by_key.items() if key in self._saved_locations and key not in locations_added
+            ],
+            'kv_upsert': [(key, pickle.dumps(bot_data[key])) for key in dirty_kv if key in bot_data],
+            'kv_delete': [(key,) for key in dirty_kv if key not in bot_data and key in self._saved_kv],
+            'stats_hours': stats_hours,
+            'stats_cells': stats_cells,
+        }
+        
+        self._saved_admins = admins
+        self._saved_kv |= {key for key, _ in changes['kv_upsert']}
+        self._saved_kv -= {key for (key,) in changes['kv_delete']}
+        return changes, (dirty, dirty_kv)
+
+    def _write(self, changes):
+        with self._lock:
+            cur = self.db.cursor()
+            # IMMEDIATE: ревизию берём под блокировкой записи, иначе два воркера получат одну и ту же
+            cur.execute("BEGIN IMMEDIATE")
+            try:
+                cur.execute(
+                    "INSERT INTO meta (key, value) VALUES ('rev', 1) "
+                    "ON CONFLICT (key) DO UPDATE SET value = value + 1"
+                )
+                stamp = (self._current_rev(cur), self.worker_id)
+                tag = lambda rows: [row + stamp for row in rows]
+                
+                cur.executemany("INSERT OR REPLACE INTO users (id, data, rev, worker) VALUES (?, ?, ?, ?)", tag(changes['users_upsert']))
+                cur.executemany("DELETE FROM users WHERE id = ?", changes['users_delete'])
+                cur.executemany("INSERT OR REPLACE INTO admins (id, rev, worker) VALUES (?, ?, ?)", tag(changes['admins_add']))
+                cur.executemany("DELETE FROM admins WHERE id = ?", changes['admins_delete'])
+                cur.executemany("DELETE FROM locations WHERE key = ?", changes['locations_delete'])
+                cur.executemany("INSERT OR IGNORE INTO locations (key, data, rev, worker) VALUES (?, ?, ?, ?)", tag(changes['locations_add']))
+                cur.executemany(
+                    "UPDATE locations SET data = ?, rev = ?, worker = ? WHERE key = ?",
+                    [(data, *stamp, key) for data, key in changes['locations_update']]
+                )
+                cur.executemany("INSERT OR REPLACE INTO kv (key, value, rev, worker) VALUES (?, ?, ?, ?)", tag(changes['kv_upsert']))
+                cur.executemany("DELETE FROM kv WHERE key = ?", changes['kv_delete'])
+                
+                # Гистограммы общие для всех воркеров: каждый прибавляет только метки, принятые им самим
+                cur.executemany(
+                    "INSERT INTO stats_hours (day, region, hour, n) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (day, region, hour) DO UPDATE SET n = n + excluded.n",
+                    changes['stats_hours']
+                )
+                cur.executemany(
+                    "INSERT INTO stats_cells (day, i, j, n) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (day, i, j) DO UPDATE SET n = n + excluded.n",
+                    changes['stats_cells']
+                )
+                if changes['stats_hours']:
+                    cutoff = (fine_stats.cutoff(),)
+                    cur.execute("DELETE FROM stats_hours WHERE day < ?", cutoff)
+                    cur.execute("DELETE FROM stats_cells WHERE day < ?", cutoff)
+                
+                # Удаления другие воркеры узнают по надгробиям; запись той же строки надгробие снимает
+                now = time.time()
+                deleted = [
+                    (table, str(row[0]), *stamp, now)
+                    for table, name in (('users', 'users_delete'), ('admins', 'admins_delete'),
+                                        ('locations', 'locations_delete'), ('kv', 'kv_delete'))
+                    for row in changes[name]
+                ]
+                cur.executemany(
+                    "INSERT OR REPLACE INTO tombstones (tbl, key, rev, worker, deleted_at) VALUES (?, ?, ?, ?, ?)",
+                    deleted
+                )
+                cur.executemany(
+                    "DELETE FROM tombstones WHERE tbl = ? AND key = ?",
+                    [(table, str(row[0]))
+                     for table, name in (('users', 'users_upsert'), ('admins', 'admins_add'), ('kv', 'kv_upsert'))
+                     for row in changes[name]]
+                )
+                cur.execute("COMMIT")
+            except Exception:
+                cur.execute("ROLLBACK")
+                raise
+
+    def _pull(self, since):
+        """Строки и надгробия, записанные другими воркерами после ревизии since"""
+        with self._lock:
+            cur = self.db.cursor()
+            cur.execute("BEGIN")
+            try:
+                rev = self._current_rev(cur)
+                if rev <= since:
+                    return rev, None
+                args = (since, rev, self.worker_id)
+                where = "WHERE rev > ? AND rev <= ? AND worker IS NOT ?"
+                remote = {
+                    'users': cur.execute(f"SELECT id, data FROM users {where}", args).fetchall(),
+                    'admins': cur.execute(f"SELECT id FROM admins {where}", args).fetchall(),
+                    'locations': cur.execute(f"SELECT key, data FROM locations {where} ORDER BY seq", args).fetchall(),
+                    'kv': cur.execute(f"SELECT key, value FROM kv {where}", args).fetchall(),
+                    'tombstones': cur.execute(f"SELECT tbl, key FROM tombstones {where}", args).fetchall(),
+                }
+            finally:
+                cur.execute("COMMIT")
+        return rev, remote
+
+    def _apply(self, remote):
+        """Вливает чужие изменения в bot_data и индексы; работает в потоке event loop"""
+        bot_data = self.bot_data
+        users = bot_data.setdefault('users', {})
+        admins = bot_data.setdefault('admins', set())
+        store = get_location_store(bot_data)
+        
+        for uid, raw in remote['users']:
+            # Свою несброшенную правку не затираем — она уйдёт в базу следующим сбросом
+            if uid in self._dirty_users:
+                continue
+            users[uid] = Subscriber.loads(raw)
+            subscriber_index.update(uid, users[uid])
+        
+        for (aid,) in remote['admins']:
+            admins.add(aid)
+            self._saved_admins.add(aid)
+        
+        for key, value in remote['kv']:
+            # Свою несброшенную правку ключа тоже не затираем
+            if key in self._dirty_kv:
+                continue
+            bot_data[key] = pickle.loads(value)
+            self._saved_kv.add(key)
+        
+        removed_locations = set()
+        for table, key in remote['tombstones']:
+            if table == 'users':
+                users.pop(int(key), None)
+                subscriber_index.remove(int(key))
+            elif table == 'admins':
+                admins.discard(int(key))
+                self._saved_admins.discard(int(key))
+            elif table == 'kv' and key not in self._dirty_kv:
+                bot_data.pop(key, None)
+                self._saved_kv.discard(key)
+            elif table == 'locations':
+                removed_locations.add(key)
+        
+        # Чужие метки уже в базе — в журнал хранилища их не пишем
+        journal, store.journal = store.journal, None
+        try:
+            if remote['locations']:
+                by_key = {self.location_key(loc): loc for loc in store}
+                for key, raw in remote['locations']:
+                    loc = json.loads(raw)
+                    seen = datetime.fromisoformat(loc.get('last_seen', loc['timestamp'])).timestamp()
+                    local = by_key.get(key)
+                    if local is not None:
+                        local.update(loc)
+                        store.touch(local)
+                        hotspot_index.touch(local, seen)
+                    else:
+                        store.append(loc)
+                        hotspot_index.add(loc, seen)
+                        # В stats_hours её уже прибавил принявший воркер — считаем только в памяти
+                        fine_stats.record(loc, persist=False)
+                        self._saved_locations.add(key)
+            if removed_locations:
+                store.remove_where(lambda loc: self.location_key(loc) in removed_locations)
+                self._saved_locations -= removed_locations
+        finally:
+            store.journal = journal
+        
+        return bool(remote['locations'] or removed_locations)
+
+    async def pull_changes(self):
+        """Дочитать изменения других воркеров; True, если поменялись метки"""
+        if self.bot_data is None:
+            return False
+        rev, remote = await asyncio.to_thread(self._pull, self.synced_rev)
+        self.synced_rev = rev
+        if remote is None:
+            return False
+        counts = {name: len(rows) for name, rows in remote.items() if rows}
+        if counts:
+            log_event("cluster_synced", logging.DEBUG, rev=rev, **counts)
+        return self._apply(remote)
+
+    async def flush_changes(self):
+        if self.bot_data is None:
+            return
+        
+        started = time.monotonic()
+        changes, dirty = self._collect()
+        rows = sum(len(v) for v in changes.values())
+        if not rows:
+            return
+        
+        try:
+            await asyncio.to_thread(self._write, changes)
+        except Exception as e:
+            # Вернём пометки в очередь и откатим учёт записанного — следующий сброс повторит то же самое
+            dirty_users, dirty_kv = dirty
+            self._dirty_users |= dirty_users
+            self._dirty_kv |= dirty_kv
+            self._dirty_locations |= {key for _, key in changes['locations_update']}
+            fine_stats.restore(changes['stats_hours'], changes['stats_cells'])
+            self._saved_admins -= {a for (a,) in changes['admins_add']}
+            self._saved_admins |= {a for (a,) in changes['admins_delete']}
+            self._saved_locations -= {key for key, _ in changes['locations_add']}
+            self._saved_locations |= {key for (key,) in changes['locations_delete']}
+            self._saved_kv |= {key for (key,) in changes['kv_delete']}
+            # Журнал уже вычитан: метки сверит полный проход
+            self._store = None
+            log_event("persistence_flush_failed", logging.ERROR, exc_info=True, error=str(e))
+            return
+        
+        self.last_flush_time = time.monotonic() - started
+        metrics.observe("wolt_persistence_flush_seconds", self.last_flush_time)
+        log_event("persistence_flush", rows=rows, ms=round(self.last_flush_time * 1000, 1))
+
+    async def _autoflush(self):
+        while True:
+            await asyncio.sleep(self.update_interval)
+            await self.flush_changes()
+
+    def start(self, bot_data):
+        self.attach(bot_data)
+        self._task = asyncio.create_task(self._autoflush())
+
+    async def flush(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.flush_changes()
+
+    # Остальное PTB не хранит: chat_data/user_data/conversations в боте не используются
+    async def get_bot_data(self):
+        return await asyncio.to_thread(self.load)
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def get_chat_data(self):
+        return {}
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def get_user_data(self):
+        return {}
+
+    async def update_user_data(self, user_id, data):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def drop_user_data(self, user_id):
+        pass
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+def migrate_pickle(pickle_path=PICKLE_FILE, db_path=DB_FILE):
+    """Одноразовый перенос bot_data из PicklePersistence в SQLite"""
+    with open(pickle_path, 'rb') as f:
+        bot_data = _PickleLoader(f).load().get('bot_data', {})
+    bot_data['region_bits'] = list(REGION_ORDER)
+    
+    persistence = SQLitePersistence(db_path)
+    persistence.attach(bot_data)
+    for uid in bot_data.get('users', {}):
+        persistence.mark_user(uid)
+    for key in bot_data.keys() - set(SQLitePersistence.ROW_KEYS):
+        persistence.mark_kv(key)
+    changes, _ = persistence._collect()
+    persistence._write(changes)
+    persistence.db.close()
+    
+    log_event(
+        "pickle_migrated", source=pickle_path, target=db_path,
+        users=len(bot_data.get('users', {})),
+        admins=len(bot_data.get('admins', set())),
+        locations=len(bot_data.get('locations', []))
+    )
+
+def location_changed(context, loc):
+    """Метка изменилась на месте: перекодировать в буфере, отдать в ленту, пометить строку"""
+    get_location_store(context.bot_data).touch(loc)
+    persistence = context.application.persistence
+    if isinstance(persistence, SQLitePersistence):
+        persistence.mark_location(loc)
+
+def kv_changed(context, key):
+    """Ключ bot_data вне users/admins/locations изменён или удалён: пометить для записи"""
+    persistence = context.application.persistence
+    if isinstance(persistence, SQLitePersistence):
+        persistence.mark_kv(key)
+
+def user_changed(context, uid):
+    """Настройки пользователя изменились: обновить индекс подписок и пометить строку для записи"""
+    udata = context.bot_data.get('users', {}).get(uid)
+    if udata is None:
+        subscriber_index.remove(uid)
+    else:
+        subscriber_index.update(uid, udata)
+    
+    persistence = context.application.persistence
+    if isinstance(persistence, SQLitePersistence):
+        persistence.mark_user(uid)
+
+# --- КЛАСТЕР ---
+class Cluster:
+    """Воркеры над общей SQLite: аренда лидера, дочитывание чужих изменений, доли рассылки"""
+
+    LEASE = 'publisher'
+
+    def __init__(self, worker_id=WORKER_ID, workers=WORKER_COUNT, index=WORKER_INDEX, lease_ttl=LEASE_TTL):
+        self.worker_id = worker_id
+        self.workers = max(workers, 1)
+        self.index = index
+        self.lease_ttl = lease_ttl
+        self.enabled = self.workers > 1
+        # Один воркер — сам себе лидер
+        self.is_leader = not self.enabled
+        self.persistence = None
+        self.fanout_cursor = 0
+        self.fanout_done = 0
+        self.routed_out = 0
+        self.routed_in = 0
+        self._tasks = []
+
+    def owns(self, uid):
+        """Пользователь в доле этого воркера"""
+        return uid % self.workers == self.index
+
+    def route_target(self, update):
+        """Индекс воркера, который должен разобрать апдейт; None — разбираем сами.
+        Черновики диалогов и замки пользователя живут в памяти воркера — все апдейты пользователя идут к одному"""
+        user = update.effective_user
+        if not self.enabled or user is None or self.owns(user.id):
+            return None
+        return user.id % self.workers
+
+    # Всё ниже с базой — в потоке, через соединение и блокировку персистентности
+    def _db(self):
+        return self.persistence.db, self.persistence._lock
+
+    def _acquire_lease(self):
+        """Продлить свою аренду или забрать просроченную; True, если лидер мы"""
+        db, lock = self._db()
+        now = time.time()
+        with lock:
+            db.execute(
+                "INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at "
+                "WHERE leases.holder = excluded.holder OR leases.expires_at < ?",
+                (self.LEASE, self.worker_id, now + self.lease_ttl, now)
+            )
+            row = db.execute("SELECT holder FROM leases WHERE name = ?", (self.LEASE,)).fetchone()
+        return bool(row) and row[0] == self.worker_id
+
+    async def try_lead(self):
+        """Взять аренду лидера сейчас, не дожидаясь цикла синхронизации; is_leader обновит сам цикл"""
+        if not self.enabled:
+            return True
+        return await asyncio.to_thread(self._acquire_lease)
+
+    def _release_lease(self):
+        db, lock = self._db()
+        with lock:
+            db.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (self.LEASE, self.worker_id))
+
+    def _cursor_key(self):
+        # Курсор принадлежит доле, а не процессу: перезапущенный воркер продолжает с того же места
+        return f"fanout_cursor:{self.index}"
+
+    def _load_cursor(self):
+        db, lock = self._db()
+        with lock:
+            row = db.execute("SELECT value FROM meta WHERE key = ?", (self._cursor_key(),)).fetchone()
+            if row:
+                return row[0]
+            return db.execute("SELECT COALESCE(MAX(id), 0) FROM fanout").fetchone()[0]
+
+    def _save_cursor(self, cursor):
+        db, lock = self._db()
+        with lock:
+            db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (self._cursor_key(), cursor))
+
+    def _insert_job(self, loc):
+        db, lock = self._db()
+        with lock:
+            db.execute(
+                "INSERT INTO fanout (data, created_at) VALUES (?, ?)",
+                (json.dumps(loc, ensure_ascii=False), time.time())
+            )
+
+    def _fetch_jobs(self, limit=100):
+        db, lock = self._db()
+        with lock:
+            return db.execute(
+                "SELECT id, data, created_at FROM fanout WHERE id > ? ORDER BY id LIMIT ?",
+                (self.fanout_cursor, limit)
+            ).fetchall()
+
+    def _insert_routed(self, target, raw):
+        db, lock = self._db()
+        with lock:
+            db.execute(
+                "INSERT INTO routed (target, data, created_at) VALUES (?, ?, ?)",
+                (target, raw, time.time())
+            )
+
+    def _take_routed(self, limit=100):
+        """Апдейты, переданные этой доле; выбираются и удаляются одной транзакцией"""
+        db, lock = self._db()
+        with lock:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                rows = db.execute(
+                    "SELECT id, data, created_at FROM routed WHERE target = ? ORDER BY id LIMIT ?",
+                    (self.index, limit)
+                ).fetchall()
+                if rows:
+                    db.execute("DELETE FROM routed WHERE target = ? AND id <= ?", (self.index, rows[-1][0]))
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+        return rows
+
+    def _purge(self):
+        """Старые задания рассылки, непринятые апдейты и надгробия; чистит только лидер"""
+        db, lock = self._db()
+        cutoff = time.time() - CLUSTER_RETENTION
+        with lock:
+            db.execute("DELETE FROM fanout WHERE created_at < ?", (cutoff,))
+            # Доля без живого воркера: её апдейты устаревают быстрее, чем кто-то их заберёт
+            db.execute("DELETE FROM routed WHERE created_at < ?", (time.time() - FANOUT_MAX_AGE,))
+            db.execute("DELETE FROM tombstones WHERE deleted_at < ?", (cutoff,))
+
+    async def route(self, target, raw):
+        """Передать апдейт (JSON от Telegram) воркеру target"""
+        await asyncio.to_thread(self._insert_routed, target, raw)
+        self.routed_out += 1
+
+    async def enqueue_fanout(self, loc):
+        """Метка на рассылку: каждый воркер разошлёт её своей доле подписчиков"""
+        await asyncio.to_thread(self._insert_job, loc)
+
+    async def _sync_loop(self, app):
+        lease_checked = 0
+        while True:
+            try:
+                if time.monotonic() - lease_checked >= self.lease_ttl / 3:
+                    lease_checked = time.monotonic()
+                    leader = await asyncio.to_thread(self._acquire_lease)
+                    if leader != self.is_leader:
+                        self.is_leader = leader
+                        log_event("cluster_leader_changed", worker=self.worker_id, leader=leader)
+                        if leader:
+                            # Новый лидер сразу публикует то, что видит сейчас
+                            await save_data(app)
+                    if leader:
+                        await asyncio.to_thread(self._purge)
+
+                if await self.persistence.pull_changes():
+                    await save_data(app)
+            except Exception as e:
+                log_event("cluster_sync_failed", logging.ERROR, exc_info=True, error=str(e))
+            await asyncio.sleep(CLUSTER_SYNC_INTERVAL)
+
+    async def _fanout_loop(self, app):
+        context = CallbackContext(app)
+        self.fanout_cursor = await asyncio.to_thread(self._load_cursor)
+        while True:
+            try:
+                jobs = await asyncio.to_thread(self._fetch_jobs)
+                for job_id, raw, created_at in jobs:
+                    age = time.time() - created_at
+                    if age <= FANOUT_MAX_AGE:
+                        # Задержку считаем от приёма метки другим воркером, а не от выборки задания
+                        await notify_users(
+                            context, json.loads(raw),
+                            received_at=time.monotonic() - age, partition=self.owns
+                        )
+                    else:
+                        log_event("fanout_expired", logging.WARNING, job=job_id, age=round(age))
+                    self.fanout_cursor = job_id
+                    self.fanout_done += 1
+                if jobs:
+                    await asyncio.to_thread(self._save_cursor, self.fanout_cursor)
+            except Exception as e:
+                log_event("cluster_fanout_failed", logging.ERROR, exc_info=True, error=str(e))
+            await asyncio.sleep(CLUSTER_SYNC_INTERVAL)
+
+    async def _route_loop(self, app):
+        while True:
+            try:
+                for _, raw, created_at in await asyncio.to_thread(self._take_routed):
+                    if time.time() - created_at > FANOUT_MAX_AGE:
+                        continue
+                    await app.update_queue.put(Update.de_json(json.loads(raw), app.bot))
+                    self.routed_in += 1
+            except Exception as e:
+                log_event("cluster_route_failed", logging.ERROR, exc_info=True, error=str(e))
+            await asyncio.sleep(CLUSTER_ROUTE_INTERVAL)
+
+    def start(self, app):
+        if not self.enabled:
+            return
+        if not isinstance(app.persistence, SQLitePersistence):
+            log_event("cluster_disabled", logging.WARNING, reason="no_sqlite_persistence")
+            self.enabled, self.is_leader = False, True
+            return
+        self.persistence = app.persistence
+        self._tasks = [
+            asyncio.create_task(self._sync_loop(app)),
+            asyncio.create_task(self._fanout_loop(app)),
+            asyncio.create_task(self._route_loop(app)),
+        ]
+        log_event("cluster_started", worker=self.worker_id, index=self.index, workers=self.workers)
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        if self.enabled and self.persistence:
+            # Отдаём аренду сразу, чтобы другой воркер не ждал LEASE_TTL
+            await asyncio.to_thread(self._release_lease)
+            self.is_leader = False
+
+    def stats(self):
+        return {
+            'worker': self.worker_id,
+            'index': self.index,
+            'workers': self.workers,
+            'leader': self.is_leader,
+            'fanout_cursor': self.fanout_cursor,
+            'fanout_done': self.fanout_done,
+            'routed_out': self.routed_out,
+            'routed_in': self.routed_in,
+            'synced_rev': self.persistence.synced_rev if self.persistence else None,
+        }
+
+cluster = Cluster()
 
-@server.route('/health')
-def health_check():
-    return {"status": "ok", "message": "I am alive!"}, 200
+# --- РАССЫЛКА ---
+class TokenBucket:
+    """Token bucket: rate токенов в секунду, запас не больше capacity"""
 
-def run_flask():
-    port = int(os.environ.get("PORT", 10000))
-    server.run(host='0.0.0.0', port=port)
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
 
-# --- РЕГИОНЫ ---
-REGIONS = {
-    'tel_aviv': {'name': 'Тель-Авив', 'coords': (32.0853, 34.7818), 'radius': 8},
-    'rishon': {'name': 'Ришон ле-Цион', 'coords': (31.9730, 34.7925), 'radius': 7},
-    'bat_yam': {'name': 'Бат-Ям', 'coords': (32.0178, 34.7478), 'radius': 5},
-    'ramat_gan': {'name': 'Рамат-Ган', 'coords': (32.0806, 34.8239), 'radius': 5},
-    'holon': {'name': 'Холон', 'coords': (32.0167, 34.7667), 'radius': 5},
-    'givatayim': {'name': 'Гиватаим', 'coords': (32.0706, 34.8106), 'radius': 4},
-    'petach_tikva': {'name': 'Петах-Тиква', 'coords': (32.0900, 34.8878), 'radius': 7},
-    'netanya': {'name': 'Нетания', 'coords': (32.3314, 34.8467), 'radius': 6},
-    'herzliya': {'name': 'Герцлия', 'coords': (32.1661, 34.8367), 'radius': 5},
-    'raanana': {'name': 'Раанана', 'coords': (32.1858, 34.8706), 'radius': 5},
-    'kfar_saba': {'name': 'Кфар-Саба', 'coords': (32.1764, 34.9064), 'radius': 5},
-    'haifa': {'name': 'Хайфа', 'coords': (32.7940, 34.9896), 'radius': 10},
-    'jerusalem': {'name': 'Иерусалим', 'coords': (31.7683, 35.2137), 'radius': 10},
-    'beersheba': {'name': 'Беэр-Шева', 'coords': (31.2518, 34.7913), 'radius': 8},
-    'ashdod': {'name': 'Ашдод', 'coords': (31.8044, 34.6553), 'radius': 6},
-    'ashkelon': {'name': 'Ашкелон', 'coords': (31.6688, 34.5742), 'radius': 6}
-}
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
 
-# --- ФУНКЦИИ ---
-def calculate_distance(lat1, lon1, lat2, lon2):
-    from math import radians, sin, cos, sqrt, atan2
-    R = 6371
-    lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
-    dlat, dlon = lat2 - lat1, lon2 - lon1
-    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-    return R * 2 * atan2(sqrt(a), sqrt(1-a))
+    def try_acquire(self, n=1):
+        self._refill()
+        if self.tokens >= n:
+            self.tokens -= n
+            return True
+        return False
 
-def get_location_region(latitude, longitude):
-    for r_id, r_data in REGIONS.items():
-        dist = calculate_distance(latitude, longitude, *r_data['coords'])
-        if dist <= r_data['radius']:
-            print(f"📍 Region: {r_data['name']} (dist: {dist:.2f}km)")
-            return r_id
-    print(f"⚠️ No region match for: {latitude}, {longitude}")
-    return None
+    async def acquire(self, n=1):
+        while not self.try_acquire(n):
+            await asyncio.sleep((n - self.tokens) / self.rate)
 
-def upload_to_github(data):
-    try:
-        print(f"\n{'='*60}")
-        print(f"🔄 GITHUB UPLOAD START")
-        print(f"{'='*60}")
-        print(f"Locations to upload: {len(data.get('locations', []))}")
-        
-        url = f"https://api.github.com/repos/{GITHUB_USERNAME}/{GITHUB_REPO}/contents/{GITHUB_FILE}"
-        headers = {
-            "Authorization": f"token {GITHUB_TOKEN}",
-            "Accept": "application/vnd.github.v3+json"
-        }
-        
-        print(f"📡 GET {url}")
-        res = requests.get(url, headers=headers, timeout=10)
-        print(f"Response: {res.status_code}")
-        
-        if res.status_code == 200:
-            sha = res.json().get("sha")
-            print(f"✅ File exists, SHA: {sha[:10]}...")
-        elif res.status_code == 404:
-            sha = None
-            print(f"⚠️ File not found, will create new")
-        else:
-            print(f"❌ Unexpected response: {res.text[:200]}")
-            return
-        
-        content = json.dumps(data, ensure_ascii=False, indent=2)
-        payload = {
-            "message": f"Update: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
-            "content": b64encode(content.encode()).decode(),
-        }
-        if sha:
-            payload["sha"] = sha
-        
-        print(f"📤 PUT to GitHub...")
-        res = requests.put(url, headers=headers, json=payload, timeout=10)
-        print(f"Response: {res.status_code}")
-        
-        if res.status_code in [200, 201]:
-            print(f"✅ SUCCESS! GitHub updated")
-            print(f"🔗 https://github.com/{GITHUB_USERNAME}/{GITHUB_REPO}/blob/main/{GITHUB_FILE}")
-        else:
-            print(f"❌ FAILED: {res.text[:200]}")
+class IngestLimiter:
+    """Лимит приёма меток: по корзине на отправителя и на чат, метка проходит только если есть токен в обеих"""
+
+    def __init__(self):
+        self.buckets = {}   # (scope, id) -> TokenBucket
+        self.rejected = {'user': 0, 'chat': 0}
+
+    def _bucket(self, scope, key, per_min, burst):
+        bucket = self.buckets.get((scope, key))
+        rate = per_min / 60
+        # Админ поменял лимит — корзина пересоздаётся с новыми параметрами
+        if bucket is None or bucket.rate != rate or bucket.capacity != burst:
+            bucket = self.buckets[(scope, key)] = TokenBucket(rate, burst)
+        return bucket
+
+    def check(self, keys, limits):
+        """keys: [(scope, id)]; вернёт None, если пропускаем, иначе scope, упёршийся в лимит"""
+        buckets = []
+        for scope, key in keys:
+            per_min, burst = limits[scope]
+            if per_min <= 0:
+                continue
+            bucket = self._bucket(scope, key, per_min, max(int(burst), 1))
+            bucket._refill()
+            if bucket.tokens < 1:
+                self.rejected[scope] += 1
+                metrics.inc("wolt_ingest_throttled_total", scope=scope)
+                return scope
+            buckets.append(bucket)
+        for bucket in buckets:
+            bucket.tokens -= 1
+        return None
+
+    def prune(self):
+        # Полная корзина ничем не отличается от новой — память только под активных отправителей
+        for key, bucket in list(self.buckets.items()):
+            bucket._refill()
+            if bucket.tokens >= bucket.capacity:
+                del self.buckets[key]
+
+def ingest_limits(bot_data):
+    return bot_data.setdefault('ingest_limits', {
+        'user': [INGEST_USER_PER_MIN, INGEST_USER_BURST],
+        'chat': [INGEST_CHAT_PER_MIN, INGEST_CHAT_BURST],
+    })
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(q / 100 * len(sorted_values)))]
+
+def retry_after_seconds(error):
+    ra = error.retry_after
+    return ra.total_seconds() if isinstance(ra, timedelta) else float(ra)
+
+class NotificationSender:
+    """Параллельная рассылка с общим лимитом скорости, паузой на чат и обработкой flood wait"""
+
+    def __init__(self, rate=SEND_RATE, concurrency=SEND_CONCURRENCY, chat_interval=CHAT_MIN_INTERVAL, max_retries=SEND_MAX_RETRIES):
+        self.bucket = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.chat_interval = chat_interval
+        self.max_retries = max_retries
+        self._chat_next = {}        # chat_id -> когда можно писать в этот чат снова
+        self._paused_until = 0      # глобальная пауза после RetryAfter
+        self.in_flight = 0
+
+    async def _wait_slot(self, chat_id):
+        now = time.monotonic()
+        # Резервируем слот чата до await, чтобы параллельные отправки не взяли тот же
+        slot = max(now, self._chat_next.get(chat_id, 0), self._paused_until)
+        self._chat_next[chat_id] = slot + self.chat_interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+        await self.bucket.acquire()
+        # Пока ждали, кто-то мог словить flood wait
+        pause = self._paused_until - time.monotonic()
+        if pause > 0:
+            await asyncio.sleep(pause)
+
+    async def call(self, method, chat_id, **kwargs):
+        """Один API-вызов с ретраями. Forbidden/BadRequest пробрасываются сразу"""
+        for attempt in range(self.max_retries + 1):
+            await self._wait_slot(chat_id)
+            try:
+                return await method(chat_id=chat_id, **kwargs)
+            except RetryAfter as e:
+                # Flood wait касается всего бота — тормозим все отправки
+                wait = retry_after_seconds(e)
+                self._paused_until = max(self._paused_until, time.monotonic() + wait)
+                log_event("send_retry_after", logging.WARNING, chat_id=chat_id, wait=wait)
+                if attempt == self.max_retries:
+                    raise
+            except (Forbidden, BadRequest):
+                raise
+            except NetworkError:
+                if attempt == self.max_retries:
+                    raise
+                await asyncio.sleep(2 ** attempt)
+
+    async def fan_out(self, recipients, deliver, started_at=None):
+        """Прогоняет deliver(uid) по получателям пулом воркеров; возвращает отчёт"""
+        started_at = started_at or time.monotonic()
+        queue = deque(recipients)
+        report = {'sent': 0, 'failed': 0, 'blocked': [], 'latencies': []}
+
+        async def worker():
+            while queue:
+                uid = queue.popleft()
+                self.in_flight += 1
+                try:
+                    await deliver(uid)
+                    report['sent'] += 1
+                    report['latencies'].append(time.monotonic() - started_at)
+                except Forbidden:
+                    # Пользователь заблокировал бота
+                    report['blocked'].append(uid)
+                except BadRequest as e:
+                    if 'chat not found' in str(e).lower():
+                        report['blocked'].append(uid)
+                    else:
+                        report['failed'] += 1
+                        log_event("send_failed", logging.DEBUG, chat_id=uid, error=str(e))
+                except Exception as e:
+                    report['failed'] += 1
+                    log_event("send_failed", logging.DEBUG, chat_id=uid, error=str(e))
+                finally:
+                    self.in_flight -= 1
+
+        await asyncio.gather(*(worker() for _ in range(min(self.concurrency, len(queue)))))
         
-        print(f"{'='*60}\n")
+        # Старые слоты чатов больше не нужны
+        now = time.monotonic()
+        if len(self._chat_next) > 10000:
+            self._chat_next = {c: t for c, t in self._chat_next.items() if t > now}
         
-    except Exception as e:
-        print(f"❌ Exception: {e}")
-        import traceback
-        traceback.print_exc()
+        lat = sorted(report.pop('latencies'))
+        report['p50'], report['p95'], report['p99'] = (percentile(lat, q) for q in (50, 95, 99))
+        return report
 
-async def save_data(context):
-    locations = context.bot_data.get('locations', [])
-    data = {
-        'locations': locations,
-        'updated_at': datetime.now().isoformat(),
-        'total_count': len(locations)
-    }
-    print(f"💾 Saving data to GitHub: {len(locations)} locations")
-    upload_to_github(data)
+# Лимит Telegram — на токен бота, поэтому воркеры делят его поровну
+sender = NotificationSender(rate=SEND_RATE / max(WORKER_COUNT, 1))
+ingest_limiter = IngestLimiter()
+
+def drop_blocked_users(context, uids):
+    users = context.bot_data.get('users', {})
+    for uid in uids:
+        users.pop(uid, None)
+        user_changed(context, uid)
+    if uids:
+        log_event("users_dropped_blocked", count=len(uids))
+
+def in_quiet_hours(udata, now):
+    quiet = udata.get('quiet')
+    if not quiet:
+        return False
+    start, end = quiet
+    return start <= now.hour < end if start < end else now.hour >= start or now.hour < end
+
+def is_deferred(udata, now):
+    """Метку не шлём сразу: пользователь на сводке или у него тихие часы"""
+    return udata.get('delivery') == 'digest' or in_quiet_hours(udata, now)
+
+def digest_key():
+    # Свой ключ на долю рассылки: в кластере kv сливается целиком по ключу
+    return f"digest_pending:{cluster.index}"
+
+def digest_pending(bot_data):
+    return bot_data.setdefault(digest_key(), {})
+
+def queue_digest(context, uids, rid, loc):
+    pending = digest_pending(context.bot_data)
+    kv_changed(context, digest_key())
+    item = (rid, loc['timestamp'])
+    now = time.time()
+    for uid in uids:
+        entry = pending.get(uid)
+        if entry is None:
+            entry = pending[uid] = {'since': now, 'count': 0, 'items': []}
+        entry['count'] += 1
+        if len(entry['items']) < DIGEST_MAX_ITEMS:
+            entry['items'].append(item)
+
+def digest_due(entry, udata, now, now_ts):
+    if in_quiet_hours(udata, now):
+        return False
+    if udata.get('delivery') == 'digest':
+        return now_ts - entry['since'] >= udata.get('digest_min', DIGEST_CHOICES[0]) * 60
+    # Мгновенный режим: копилось только на время тихих часов
+    return True
+
+def digest_text(entry):
+    by_region = {}
+    for rid, ts in entry['items']:
+        by_region.setdefault(rid, []).append(ts)
+    
+    lines = [f"🗞 <b>Сводка: новых меток — {entry['count']}</b>", ""]
+    for rid, stamps in sorted(by_region.items(), key=lambda kv: -len(kv[1])):
+        # Метки хранят время сервера без пояса — пользователю показываем LOCAL_TZ
+        last = datetime.fromisoformat(max(stamps)).astimezone(LOCAL_TZ).strftime('%H:%M')
+        name = REGIONS[rid]['name'] if rid in REGIONS else "Твоя зона"
+        lines.append(f"📍 {name}: <b>{len(stamps)}</b> (последняя в {last})")
+    if entry['count'] > len(entry['items']):
+        lines.append(f"…и ещё {entry['count'] - len(entry['items'])}")
+    return "\n".join(lines)
+
+async def digest_job(context: ContextTypes.DEFAULT_TYPE):
+    """Одна сводка на пользователя вместо пары сообщений на каждую метку"""
+    pending = digest_pending(context.bot_data)
+    if not pending:
+        return
+    
+    users = context.bot_data.get('users', {})
+    now, now_ts = local_now(), time.time()
+    due = {}
+    for uid, entry in list(pending.items()):
+        udata = users.get(uid)
+        if udata is None or not udata.get('notifications'):
+            del pending[uid]
+        elif digest_due(entry, udata, now, now_ts):
+            due[uid] = pending.pop(uid)
+        else:
+            continue
+        kv_changed(context, digest_key())
+    if not due:
+        return
+    
+    kb = InlineKeyboardMarkup([[InlineKeyboardButton("🗺 Открыть карту", web_app=WebAppInfo(url=WEBAPP_URL))]])
+    
+    async def deliver(uid):
+        await sender.call(
+            context.bot.send_message, uid,
+            text=digest_text(due[uid]),
+            parse_mode='HTML',
+            reply_markup=kb
+        )
+    
+    report = await sender.fan_out(list(due), deliver)
+    drop_blocked_users(context, report['blocked'])
+    
+    for status in ('sent', 'failed'):
+        metrics.inc("wolt_digests_total", report[status], status=status)
+    metrics.inc("wolt_digests_total", len(report['blocked']), status="blocked")
+    log_event(
+        "digest_done", users=len(due), fines=sum(e['count'] for e in due.values()),
+        sent=report['sent'], blocked=len(report['blocked']), failed=report['failed'],
+        waiting=len(pending)
+    )
 
 # --- ХЕНДЛЕРЫ ---
+class StateLocks:
+    """asyncio-замки над bot_data при параллельных апдейтах: на пользователя и на коллекцию.
+    Порядок захвата — пользователь, потом коллекция; сам PTB апдейты не упорядочивает"""
+
+    def __init__(self):
+        # Замок живёт, пока его кто-то держит или ждёт — под неактивных пользователей память не копится
+        self._users = weakref.WeakValueDictionary()
+        self._collections = {}
+
+    def user(self, uid):
+        lock = self._users.get(uid)
+        if lock is None:
+            lock = self._users[uid] = asyncio.Lock()
+        return lock
+
+    def collection(self, name):
+        lock = self._collections.get(name)
+        if lock is None:
+            lock = self._collections[name] = asyncio.Lock()
+        return lock
+
+state_locks = StateLocks()
+
+def serialized(collection=None):
+    """Хендлер под замком: апдейты одного пользователя (или правки одной коллекции) идут по очереди"""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            if collection:
+                lock = state_locks.collection(collection)
+            elif update.effective_user:
+                lock = state_locks.user(update.effective_user.id)
+            else:
+                return await handler(update, context)
+            async with lock:
+                return await handler(update, context)
+        return wrapper
+    return decorator
+
+# Черновики диалогов — ключи bot_data на пользователя (temp_regions:{uid}, zone_pending:{uid}).
+# Время последней записи держим в памяти: после рестарта отсчёт срока начинается заново
+DRAFT_PREFIXES = ('temp_regions:', 'zone_pending:')
+draft_touched = {}
+
+def set_draft(context, key, value):
+    context.bot_data[key] = value
+    draft_touched[key] = time.time()
+    kv_changed(context, key)
+
+def pop_draft(context, key, default=None):
+    draft_touched.pop(key, None)
+    if key not in context.bot_data:
+        return default
+    kv_changed(context, key)
+    return context.bot_data.pop(key)
+
+def toggle_draft_region(context, uid, rid):
+    temp = set(context.bot_data.get(f"temp_regions:{uid}", ()))
+    temp.remove(rid) if rid in temp else temp.add(rid)
+    set_draft(context, f"temp_regions:{uid}", temp)
+    return temp
+
+async def expire_drafts_job(context: ContextTypes.DEFAULT_TYPE):
+    """Брошенные черновики (начал выбор регионов или «Задать точку» и ушёл) — не дольше DRAFT_TTL_HOURS"""
+    now = time.time()
+    expired = [
+        key for key in list(context.bot_data)
+        if key.startswith(DRAFT_PREFIXES) and now - draft_touched.setdefault(key, now) >= DRAFT_TTL_HOURS * 3600
+    ]
+    for key in expired:
+        pop_draft(context, key)
+    if expired:
+        log_event("drafts_expired", drafts=len(expired))
+
+@serialized()
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
@@ -157,7 +2695,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await show_menu(update, context)
     else:
         # Новый пользователь - регистрация
-        context.bot_data.setdefault('temp_regions', {})[user_id] = set()
+        set_draft(context, f"temp_regions:{user_id}", set())
         await update.message.reply_text(
             "👋 Привет! Выбери регионы для уведомлений:",
             reply_markup=InlineKeyboardMarkup(build_keyboard(set(), "reg"))
@@ -183,6 +2721,55 @@ def build_keyboard(selected, prefix):
         kb.append([InlineKeyboardButton("✅ Сохранить", callback_data="set_done")])
     return kb
 
+def settings_view(udata):
+    notif = "✅ Включены" if udata.get('notifications') else "❌ Выключены"
+    if udata.get('delivery') == 'digest':
+        delivery = f"сводка раз в {udata.get('digest_min', DIGEST_CHOICES[0])} мин"
+    else:
+        delivery = "сразу"
+    quiet = f"{udata['quiet'][0]:02d}:00–{udata['quiet'][1]:02d}:00" if udata.get('quiet') else "выкл"
+    zone = f"{udata['zone']['radius']} км" if udata.get('zone') else "нет"
+    txt = (
+        f"⚙️ <b>Настройки</b>\n\n"
+        f"🔔 Уведомления: {notif}\n"
+        f"📬 Доставка: {delivery}\n"
+        f"🌙 Тихие часы: {quiet}\n"
+        f"🎯 Моя зона: {zone}\n"
+        f"📍 Регионов: {len(udata.get('regions', []))}"
+    )
+    kb = [
+        [InlineKeyboardButton("📍 Изменить регионы", callback_data="set_regs")],
+        [InlineKeyboardButton("🔔 Вкл/Выкл", callback_data="notif_toggle")],
+        [InlineKeyboardButton("📬 Режим доставки", callback_data="delivery")],
+        [InlineKeyboardButton("🌙 Тихие часы", callback_data="quiet")],
+        [InlineKeyboardButton("🎯 Моя зона", callback_data="zone")],
+        [InlineKeyboardButton("« Назад", callback_data="main")]
+    ]
+    return txt, kb
+
+def zone_view(udata):
+    zone = udata.get('zone')
+    if zone:
+        txt = (
+            f"🎯 <b>Моя зона</b>\n\n"
+            f"Центр: <code>{zone['lat']:.5f}, {zone['lon']:.5f}</code>\n"
+            f"Радиус: {zone['radius']} км\n\n"
+            f"Метки внутри зоны придут, даже если район не выбран."
+        )
+    else:
+        txt = "🎯 <b>Моя зона</b>\n\nОтправь точку — и получай метки в радиусе от неё, независимо от районов."
+    current = zone['radius'] if zone else None
+    mark = lambda on: "✅ " if on else ""
+    kb = [[
+        InlineKeyboardButton(f"{mark(current == r)}{r} км", callback_data=f"zone_r_{r}")
+        for r in ZONE_RADIUS_CHOICES
+    ]] if zone else []
+    kb.append([InlineKeyboardButton("📍 Задать точку", callback_data="zone_set")])
+    if zone:
+        kb.append([InlineKeyboardButton("🗑 Удалить зону", callback_data="zone_off")])
+    kb.append([InlineKeyboardButton("« Назад", callback_data="settings")])
+    return txt, kb
+
 async def show_menu(update, context):
     uid = update.effective_user.id
     kb = [
@@ -213,11 +2800,13 @@ async def show_menu(update, context):
             reply_markup=reply_kb
         )
 
+@serialized()
 async def menu_button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик кнопки 📍 Меню"""
     if update.message.text == "📍 Меню":
         await show_menu(update, context)
 
+@serialized('admins')
 async def add_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Добавление админа - /addadmin USER_ID"""
     uid = update.effective_user.id
@@ -261,8 +2850,9 @@ async def add_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode='HTML'
     )
     
-    print(f"👮 Super-admin {uid} added admin {new_admin_id}")
+    log_event("admin_added", by=uid, admin_id=new_admin_id)
 
+@serialized('admins')
 async def remove_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Удаление админа - /removeadmin USER_ID"""
     uid = update.effective_user.id
@@ -302,33 +2892,61 @@ async def remove_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode='HTML'
     )
     
-    print(f"👮 Super-admin {uid} removed admin {admin_id}")
+    log_event("admin_removed", by=uid, admin_id=admin_id)
 
-async def handle_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    print(f"\n{'='*60}")
-    print(f"📍 LOCATION RECEIVED")
-    print(f"{'='*60}")
-    
-    post = update.channel_post or update.message
+@serialized('ingest_limits')
+async def rate_limit(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Лимит приёма меток - /ratelimit [user|chat PER_MIN BURST]"""
+    uid = update.effective_user.id
     
-    if not post:
-        print("❌ No post")
+    if uid != SUPER_ADMIN_ID and uid not in context.bot_data.get('admins', set()):
+        await update.message.reply_text("❌ Недостаточно прав")
         return
     
-    if not post.location:
-        print("❌ No location")
-        return
+    limits = ingest_limits(context.bot_data)
+    if context.args:
+        try:
+            scope, per_min, burst = context.args[0], float(context.args[1]), int(context.args[2])
+        except (IndexError, ValueError):
+            scope, per_min, burst = None, 0, 0
+        if scope not in limits or per_min < 0 or burst < 1:
+            await update.message.reply_text(
+                "❌ Неправильный формат\n\n"
+                "Используй: <code>/ratelimit user|chat В_МИНУТУ ПОДРЯД</code>\n"
+                "Пример: <code>/ratelimit user 4 3</code> (0 в минуту — без лимита)",
+                parse_mode='HTML'
+            )
+            return
+        limits[scope] = [per_min, burst]
+        kv_changed(context, 'ingest_limits')
+        log_event("ingest_limit_changed", by=uid, scope=scope, per_min=per_min, burst=burst)
+    
+    fmt = lambda scope: f"{limits[scope][0]:g}/мин, подряд {limits[scope][1]}" if limits[scope][0] > 0 else "без лимита"
+    await update.message.reply_text(
+        f"🚦 <b>Лимит приёма меток</b>\n\n"
+        f"👤 На отправителя: {fmt('user')}\n"
+        f"💬 На чат: {fmt('chat')}\n\n"
+        f"Отклонено: {ingest_limiter.rejected['user']} (отправитель), {ingest_limiter.rejected['chat']} (чат)",
+        parse_mode='HTML'
+    )
+
+async def handle_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    received_at = time.monotonic()
+    post = update.channel_post or update.message
     
-    print(f"Chat ID: {post.chat.id}")
-    print(f"Chat Username: {post.chat.username if hasattr(post.chat, 'username') else 'None'}")
-    print(f"Chat Title: {post.chat.title if hasattr(post.chat, 'title') else 'None'}")
-    print(f"Chat Type: {post.chat.type}")
-    print(f"Message ID: {post.message_id}")
-    print(f"From User: {post.from_user.first_name if post.from_user else 'None'}")
-    print(f"Location: {post.location.latitude}, {post.location.longitude}")
+    if not post or not post.location:
+        log_event("location_skipped", logging.DEBUG, reason="no_location")
+        return
     
-    if hasattr(post, 'message_thread_id') and post.message_thread_id:
-        print(f"Thread ID: {post.message_thread_id}")
+    log_event(
+        "location_received", logging.DEBUG,
+        chat_id=post.chat.id, chat_type=post.chat.type,
+        chat_title=getattr(post.chat, 'title', None),
+        thread_id=getattr(post, 'message_thread_id', None),
+        message_id=post.message_id,
+        from_user=post.from_user.first_name if post.from_user else None,
+        lat=post.location.latitude, lon=post.location.longitude
+    )
     
     # 🔍 ВРЕМЕННО: Принимаем из любого канала чтобы узнать ID
     # После того как узнаем ID, включим проверку обратно
@@ -337,96 +2955,165 @@ async def handle_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     
     if not is_valid_chat:
-        print(f"⚠️ Wrong chat type: {post.chat.type}")
+        log_event("location_skipped", logging.DEBUG, reason="chat_type", chat_type=post.chat.type)
         return
     
-    print(f"✅ Chat OK")
-    
-    loc = {
-        'latitude': post.location.latitude,
-        'longitude': post.location.longitude,
-        'timestamp': datetime.now().isoformat(),
-        'user': post.from_user.first_name if post.from_user else "Admin",
-        'message_id': post.message_id
-    }
-    
-    print(f"\n📝 Location object:")
-    print(json.dumps(loc, indent=2, ensure_ascii=False))
-    
-    context.bot_data.setdefault('locations', []).append(loc)
-    context.bot_data['locations'] = context.bot_data['locations'][-200:]
+    # Ответ на «Задать точку» в настройках: это центр личной зоны, а не метка. Черновик смотрим под замком
+    # пользователя: геопозиция сразу после нажатия дождётся кнопки и не уйдёт в публичные метки
+    uid = post.from_user.id if post.from_user else None
+    if post.chat.type == 'private' and uid is not None:
+        async with state_locks.user(uid):
+            users = context.bot_data.setdefault('users', {})
+            if pop_draft(context, f"zone_pending:{uid}") and uid in users:
+                old = users[uid].get('zone') or {}
+                users[uid]['zone'] = {
+                    'lat': post.location.latitude,
+                    'lon': post.location.longitude,
+                    'radius': old.get('radius', ZONE_RADIUS_CHOICES[1]),
+                }
+                user_changed(context, uid)
+                log_event("zone_set", user_id=uid, radius=users[uid]['zone']['radius'])
+                txt, kb = zone_view(users[uid])
+                await post.reply_text("✅ Зона сохранена", reply_markup=ReplyKeyboardMarkup([[KeyboardButton("📍 Меню")]], resize_keyboard=True))
+                await post.reply_text(txt, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(kb))
+                return
     
-    print(f"\n💾 Total in memory: {len(context.bot_data['locations'])}")
-    
-    print(f"\n🔄 Saving to GitHub...")
-    await save_data(context)
+    # Лимит приёма: один отправитель или пересланная пачка не должны съесть весь бюджет рассылки
+    is_admin = uid is not None and (uid == SUPER_ADMIN_ID or uid in context.bot_data.get('admins', set()))
+    if not is_admin:
+        keys = [('chat', post.chat.id)]
+        if uid is not None:
+            keys.insert(0, ('user', uid))
+        throttled = ingest_limiter.check(keys, ingest_limits(context.bot_data))
+        if throttled:
+            log_event(
+                "location_throttled", scope=throttled, chat_id=post.chat.id,
+                user_id=uid, message_id=post.message_id
+            )
+            if post.chat.type == 'private':
+                await post.reply_text("⏳ Слишком много меток подряд — попробуй через минуту")
+            return
     
-    print(f"\n📢 Notifying users...")
-    await notify_users(context, loc)
+    # Проверка на повтор, запись и снимок — одной секцией: параллельная метка не вклинится между ними
+    async with state_locks.collection('locations'):
+        now = datetime.now()
+        
+        # Повторный отчёт о той же точке: считаем, но не рассылаем заново
+        hotspot = hotspot_index.match(post.location.latitude, post.location.longitude, now.timestamp())
+        if hotspot:
+            hotspot['report_count'] = hotspot.get('report_count', 1) + 1
+            hotspot['last_seen'] = now.isoformat()
+            hotspot_index.touch(hotspot, now.timestamp())
+            location_changed(context, hotspot)
+            log_event(
+                "location_merged", chat_id=post.chat.id, message_id=post.message_id,
+                hotspot=hotspot['message_id'], report_count=hotspot['report_count']
+            )
+            await save_data(context)
+            return
+        
+        loc = {
+            'latitude': post.location.latitude,
+            'longitude': post.location.longitude,
+            'timestamp': now.isoformat(),
+            'user': post.from_user.first_name if post.from_user else "Admin",
+            'message_id': post.message_id,
+            'report_count': 1,
+            'last_seen': now.isoformat()
+        }
+        
+        store = get_location_store(context.bot_data)
+        store.append(loc)
+        hotspot_index.add(loc, now.timestamp())
+        fine_stats.record(loc)
+        
+        log_event(
+            "location_stored", chat_id=post.chat.id, thread_id=getattr(post, 'message_thread_id', None),
+            message_id=post.message_id, total=len(store)
+        )
+        
+        await save_data(context)
     
-    print(f"{'='*60}\n")
+    # Рассылка — уже вне замка: следующая метка не ждёт, пока эта разойдётся по подписчикам
+    if cluster.enabled:
+        await cluster.enqueue_fanout(loc)
+    else:
+        await notify_users(context, loc, received_at=received_at)
 
-async def notify_users(context, loc_data):
-    print(f"📢 NOTIFY START")
-    
+@timed("notify_users")
+async def notify_users(context, loc_data, received_at=None, partition=None):
     rid = get_location_region(loc_data['latitude'], loc_data['longitude'])
+    # Личные зоны — точечный запрос к сетке; метка вне регионов тоже может в них попасть
+    zone_users = subscriber_index.zones.match(loc_data['latitude'], loc_data['longitude'])
     
-    if not rid:
-        print("⚠️ No region - skipping notifications")
+    if not rid and not zone_users:
+        log_event("notify_skipped", reason="no_region", message_id=loc_data.get('message_id'))
         return
     
-    r_name = REGIONS[rid]['name']
-    time_str = datetime.fromisoformat(loc_data['timestamp']).strftime('%H:%M')
+    r_name = REGIONS[rid]['name'] if rid else "твоя зона"
+    time_str = datetime.fromisoformat(loc_data['timestamp']).astimezone(LOCAL_TZ).strftime('%H:%M')
+    
+    total_users = len(context.bot_data.get('users', {}))
+    recipients = list(zone_users.union(subscriber_index.recipients(rid)) if zone_users else subscriber_index.recipients(rid))
+    if partition:
+        recipients = [uid for uid in recipients if partition(uid)]
     
+    # Пользователи на сводке и в тихих часах получат метку в digest_job
     users = context.bot_data.get('users', {})
-    print(f"👥 Users: {len(users)}")
+    now = local_now()
+    instant, deferred = [], []
+    for uid in recipients:
+        (deferred if is_deferred(users.get(uid, {}), now) else instant).append(uid)
+    if deferred:
+        queue_digest(context, deferred, rid, loc_data)
+        metrics.inc("wolt_notifications_total", len(deferred), status="deferred")
+    recipients = instant
     
-    sent = 0
-    for uid, udata in users.items():
-        notifications_on = udata.get('notifications', False)
-        has_region = rid in udata.get('regions', [])
-        
-        print(f"\nUser {uid}:")
-        print(f"  Notifications: {notifications_on}")
-        print(f"  Has region: {has_region}")
-        
-        if notifications_on and has_region:
-            try:
-                # ✅ СНАЧАЛА ГЕОЛОКАЦИЯ
-                await context.bot.send_location(
-                    chat_id=uid,
-                    latitude=loc_data['latitude'],
-                    longitude=loc_data['longitude']
-                )
-                
-                # ✅ ПОТОМ ТЕКСТ
-                msg = (
-                    f"🚨 <b>Новая метка!</b>\n\n"
-                    f"📍 Район: <b>{r_name}</b>\n"
-                    f"👤 Отправил: {loc_data['user']}\n"
-                    f"🕐 Время: {time_str}\n\n"
-                    f"⏱ Метка появится на карте в течение 30 секунд"
-                )
-                
-                kb = [[InlineKeyboardButton("🗺 Открыть карту", web_app=WebAppInfo(url=WEBAPP_URL))]]
-                
-                await context.bot.send_message(
-                    chat_id=uid,
-                    text=msg,
-                    parse_mode='HTML',
-                    reply_markup=InlineKeyboardMarkup(kb)
-                )
-                
-                sent += 1
-                print(f"  ✅ Sent")
-                
-            except Exception as e:
-                print(f"  ❌ Error: {e}")
-        else:
-            print(f"  ⏭ Skip")
+    msg = (
+        f"🚨 <b>Новая метка!</b>\n\n"
+        f"📍 Район: <b>{r_name}</b>\n"
+        f"👤 Отправил: {loc_data['user']}\n"
+        f"🕐 Время: {time_str}\n\n"
+        f"⏱ Метка появится на карте в течение 30 секунд"
+    )
+    kb = InlineKeyboardMarkup([[InlineKeyboardButton("🗺 Открыть карту", web_app=WebAppInfo(url=WEBAPP_URL))]])
+    
+    async def deliver(uid):
+        # ✅ СНАЧАЛА ГЕОЛОКАЦИЯ
+        await sender.call(
+            context.bot.send_location, uid,
+            latitude=loc_data['latitude'],
+            longitude=loc_data['longitude']
+        )
+        # ✅ ПОТОМ ТЕКСТ
+        await sender.call(
+            context.bot.send_message, uid,
+            text=msg,
+            parse_mode='HTML',
+            reply_markup=kb
+        )
+    
+    fanout_started = time.perf_counter()
+    report = await sender.fan_out(recipients, deliver, started_at=received_at)
+    drop_blocked_users(context, report['blocked'])
     
-    print(f"\n📊 Sent to {sent}/{len(users)} users")
+    metrics.observe("wolt_fanout_recipients", len(recipients))
+    metrics.observe("wolt_fanout_seconds", time.perf_counter() - fanout_started)
+    for status in ('sent', 'failed'):
+        metrics.inc("wolt_notifications_total", report[status], status=status)
+    metrics.inc("wolt_notifications_total", len(report['blocked']), status="blocked")
+    
+    # Одна сводка на метку вместо строк по каждому пользователю
+    rnd = lambda v: round(v, 3) if v is not None else None
+    log_event(
+        "notify_done", region=rid, message_id=loc_data.get('message_id'),
+        users=total_users, recipients=len(recipients), zone=len(zone_users), deferred=len(deferred), sent=report['sent'],
+        blocked=len(report['blocked']), failed=report['failed'],
+        p50=rnd(report['p50']), p95=rnd(report['p95']), p99=rnd(report['p99'])
+    )
+    return report
 
+@serialized()
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -434,45 +3121,125 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if data.startswith("reg_") and data != "reg_done":
         rid = data[4:]
-        temp = context.bot_data.setdefault('temp_regions', {}).setdefault(uid, set())
-        temp.remove(rid) if rid in temp else temp.add(rid)
+        temp = toggle_draft_region(context, uid, rid)
         await query.edit_message_reply_markup(
             reply_markup=InlineKeyboardMarkup(build_keyboard(temp, "reg"))
         )
     
     elif data == "reg_done":
-        sel = list(context.bot_data.setdefault('temp_regions', {}).pop(uid, []))
-        context.bot_data.setdefault('users', {})[uid] = {
-            'regions': sel,
-            'notifications': True
-        }
-        print(f"✅ User {uid} registered: {sel}")
+        sel = list(pop_draft(context, f"temp_regions:{uid}", ()))
+        udata = context.bot_data.setdefault('users', {})[uid] = Subscriber(region_mask(sel), notifications=True)
+        user_changed(context, uid)
+        log_event("user_registered", user_id=uid, regions=sel)
         await query.edit_message_text("✅ Настройка завершена! Нажми /start для открытия меню")
 
     elif data == "settings":
         udata = context.bot_data.setdefault('users', {}).get(uid, {})
-        notif = "✅ Включены" if udata.get('notifications') else "❌ Выключены"
-        txt = (
-            f"⚙️ <b>Настройки</b>\n\n"
-            f"🔔 Уведомления: {notif}\n"
-            f"📍 Регионов: {len(udata.get('regions', []))}"
-        )
-        kb = [
-            [InlineKeyboardButton("📍 Изменить регионы", callback_data="set_regs")],
-            [InlineKeyboardButton("🔔 Вкл/Выкл", callback_data="notif_toggle")],
-            [InlineKeyboardButton("« Назад", callback_data="main")]
-        ]
+        txt, kb = settings_view(udata)
         await query.edit_message_text(txt, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(kb))
 
     elif data == "notif_toggle":
         users = context.bot_data.setdefault('users', {})
         if uid in users:
             users[uid]['notifications'] = not users[uid].get('notifications')
-        await button_handler(update, context)
+            user_changed(context, uid)
+        txt, kb = settings_view(users.get(uid, {}))
+        await query.edit_message_text(txt, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(kb))
+
+    elif data == "delivery":
+        udata = context.bot_data.setdefault('users', {}).get(uid, {})
+        current = udata.get('digest_min') if udata.get('delivery') == 'digest' else None
+        mark = lambda on: "✅ " if on else ""
+        kb = [[InlineKeyboardButton(f"{mark(current is None)}⚡ Сразу", callback_data="delivery_instant")]]
+        kb += [
+            [InlineKeyboardButton(f"{mark(current == n)}🗞 Сводка раз в {n} мин", callback_data=f"delivery_{n}")]
+            for n in DIGEST_CHOICES
+        ]
+        kb.append([InlineKeyboardButton("« Назад", callback_data="settings")])
+        await query.edit_message_text(
+            "📬 Как присылать метки?\n\nСводка — одно сообщение со всеми новыми метками за период.",
+            reply_markup=InlineKeyboardMarkup(kb)
+        )
+
+    elif data.startswith("delivery_"):
+        users = context.bot_data.setdefault('users', {})
+        if uid in users:
+            choice = data[9:]
+            if choice == "instant":
+                users[uid]['delivery'] = 'instant'
+                users[uid].pop('digest_min', None)
+            elif choice.isdigit() and int(choice) in DIGEST_CHOICES:
+                users[uid]['delivery'] = 'digest'
+                users[uid]['digest_min'] = int(choice)
+            user_changed(context, uid)
+        txt, kb = settings_view(users.get(uid, {}))
+        await query.edit_message_text(txt, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(kb))
+
+    elif data == "quiet":
+        udata = context.bot_data.setdefault('users', {}).get(uid, {})
+        current = tuple(udata['quiet']) if udata.get('quiet') else None
+        mark = lambda on: "✅ " if on else ""
+        kb = [[InlineKeyboardButton(f"{mark(current is None)}Выключены", callback_data="quiet_off")]]
+        kb += [
+            [InlineKeyboardButton(f"{mark(current == q)}🌙 {q[0]:02d}:00–{q[1]:02d}:00", callback_data=f"quiet_{q[0]}_{q[1]}")]
+            for q in QUIET_CHOICES
+        ]
+        kb.append([InlineKeyboardButton("« Назад", callback_data="settings")])
+        await query.edit_message_text(
+            "🌙 Тихие часы: метки за это время придут одной сводкой, когда они закончатся.",
+            reply_markup=InlineKeyboardMarkup(kb)
+        )
+
+    elif data.startswith("quiet_"):
+        users = context.bot_data.setdefault('users', {})
+        if uid in users:
+            choice = data[6:]
+            if choice == "off":
+                users[uid].pop('quiet', None)
+            else:
+                quiet = tuple(int(h) for h in choice.split("_"))
+                if quiet in QUIET_CHOICES:
+                    users[uid]['quiet'] = list(quiet)
+            user_changed(context, uid)
+        txt, kb = settings_view(users.get(uid, {}))
+        await query.edit_message_text(txt, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(kb))
+
+    elif data == "zone":
+        txt, kb = zone_view(context.bot_data.setdefault('users', {}).get(uid, {}))
+        await query.edit_message_text(txt, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(kb))
+
+    elif data == "zone_set":
+        # Следующая геопозиция из лички станет центром зоны, а не меткой
+        set_draft(context, f"zone_pending:{uid}", True)
+        reply_kb = ReplyKeyboardMarkup(
+            [[KeyboardButton("📍 Отправить геопозицию", request_location=True)], [KeyboardButton("📍 Меню")]],
+            resize_keyboard=True, one_time_keyboard=True
+        )
+        await query.message.reply_text(
+            "Отправь геопозицию кнопкой ниже или точку через 📎 → Геопозиция",
+            reply_markup=reply_kb
+        )
+
+    elif data.startswith("zone_r_"):
+        users = context.bot_data.setdefault('users', {})
+        radius = int(data[7:]) if data[7:].isdigit() else None
+        if users.get(uid, {}).get('zone') and radius in ZONE_RADIUS_CHOICES:
+            users[uid]['zone']['radius'] = radius
+            user_changed(context, uid)
+        txt, kb = zone_view(users.get(uid, {}))
+        await query.edit_message_text(txt, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(kb))
+
+    elif data == "zone_off":
+        users = context.bot_data.setdefault('users', {})
+        if users.get(uid, {}).pop('zone', None):
+            user_changed(context, uid)
+            log_event("zone_removed", user_id=uid)
+        txt, kb = settings_view(users.get(uid, {}))
+        await query.edit_message_text(txt, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(kb))
 
     elif data == "set_regs":
         current = set(context.bot_data.setdefault('users', {}).get(uid, {}).get('regions', []))
-        context.bot_data.setdefault('temp_regions', {})[uid] = current
+        set_draft(context, f"temp_regions:{uid}", current)
         await query.edit_message_text(
             "Выбери регионы:",
             reply_markup=InlineKeyboardMarkup(build_keyboard(current, "setreg"))
@@ -480,15 +3247,16 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     elif data.startswith("setreg_"):
         rid = data[7:]
-        temp = context.bot_data.setdefault('temp_regions', {}).setdefault(uid, set())
-        temp.remove(rid) if rid in temp else temp.add(rid)
+        temp = toggle_draft_region(context, uid, rid)
         await query.edit_message_reply_markup(
             reply_markup=InlineKeyboardMarkup(build_keyboard(temp, "setreg"))
         )
     
     elif data == "set_done":
-        sel = list(context.bot_data.setdefault('temp_regions', {}).pop(uid, []))
-        context.bot_data.setdefault('users', {})[uid]['regions'] = sel
+        sel = list(pop_draft(context, f"temp_regions:{uid}", ()))
+        udata = context.bot_data.setdefault('users', {})[uid]
+        udata['regions'] = sel
+        user_changed(context, uid)
         await query.edit_message_text("✅ Регионы обновлены!")
         await show_menu(update, context)
 
@@ -502,11 +3270,17 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         total_locations = len(context.bot_data.get('locations', []))
         total_admins = len(context.bot_data.get('admins', set()))
         
+        pub = publisher.stats()
+        latency = f"{pub['last_latency']:.1f}с" if pub['last_latency'] is not None else "—"
+        
         txt = (
             f"👑 <b>Админ панель</b>\n\n"
             f"👥 Пользователей: {total_users}\n"
             f"📍 Меток сохранено: {total_locations}\n"
-            f"👮 Админов: {total_admins}\n"
+            f"👮 Админов: {total_admins}\n\n"
+            f"🚦 Отклонено лимитом: {sum(ingest_limiter.rejected.values())}\n"
+            f"📤 Очередь GitHub: {pub['queue_depth']}\n"
+            f"⏱ Последняя публикация: {latency}\n"
         )
         
         kb = [
@@ -519,23 +3293,28 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text(txt, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(kb))
     
     elif data == "admin_stats":
-        # Детальная статистика
-        users = context.bot_data.get('users', {})
-        
-        # Считаем по регионам
-        region_stats = {}
-        for uid, udata in users.items():
-            for region in udata.get('regions', []):
-                region_stats[region] = region_stats.get(region, 0) + 1
+        # Детальная статистика: всё из готовых счётчиков, без обхода пользователей и меток
+        counts = subscriber_index.counts()
+        fines = fine_stats.payload()['fines']
         
         stats_text = "\n".join([
-            f"• {REGIONS[rid]['name']}: {count} чел."
-            for rid, count in sorted(region_stats.items(), key=lambda x: -x[1])
+            f"• {REGIONS[rid]['name']}: {registered} чел. (🔔 {active})"
+            for rid, (registered, active) in sorted(counts.items(), key=lambda x: -x[1][0]) if rid in REGIONS
+        ])
+        
+        weekdays = ("пн", "вт", "ср", "чт", "пт", "сб", "вс")
+        fines_text = "\n".join([
+            f"• {REGIONS[rid]['name'] if rid in REGIONS else 'Вне регионов'}: {f['total']} "
+            f"(пик {f['by_hour'].index(max(f['by_hour'])):02d}:00, {weekdays[f['by_dow'].index(max(f['by_dow']))]})"
+            for rid, f in sorted(fines.items(), key=lambda x: -x[1]['total'])
         ])
         
         txt = (
             f"📊 <b>Статистика по регионам</b>\n\n"
-            f"{stats_text if stats_text else 'Нет данных'}"
+            f"{stats_text if stats_text else 'Нет данных'}\n"
+            f"🎯 Личных зон: {len(subscriber_index.zones)}\n\n"
+            f"🚨 <b>Метки за {STATS_DAYS} дн.</b>\n\n"
+            f"{fines_text if fines_text else 'Нет данных'}"
         )
         
         kb = [[InlineKeyboardButton("« Назад", callback_data="admin")]]
@@ -567,18 +3346,22 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.answer("❌ Недостаточно прав", show_alert=True)
             return
         
-        deleted_count = len(context.bot_data.get('locations', []))
-        context.bot_data['locations'] = []
+        async with state_locks.collection('locations'):
+            store = get_location_store(context.bot_data)
+            deleted_count = len(store)
+            store.clear()
+            
+            # Сохраняем пустой список в GitHub
+            await save_data(context)
         
-        # Сохраняем пустой список в GitHub
-        await save_data(context)
-        
-        txt = f"✅ Удалено {deleted_count} меток\n\nДанные обновлены в GitHub"
+        txt = f"✅ Удалено {deleted_count} меток\n\nКарта уже обновлена"
+        if GITHUB_MIRROR:
+            txt += f", зеркало в GitHub обновится в течение {PUBLISH_WINDOW:.0f} сек"
         
         kb = [[InlineKeyboardButton("« Назад в админку", callback_data="admin")]]
         await query.edit_message_text(txt, reply_markup=InlineKeyboardMarkup(kb))
         
-        print(f"🗑️ Admin {uid} deleted all {deleted_count} locations")
+        log_event("locations_cleared", by=uid, deleted=deleted_count)
     
     elif data == "admin_manage_admins":
         # Управление админами (только для супер-админа)
@@ -603,52 +3386,271 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif data == "main":
         await show_menu(update, context)
 
+# --- WEBHOOK (ASGI) ---
+def build_asgi_app(app):
+    """Starlette-приложение: апдейты Telegram, health, metrics и данные карты на одном event loop"""
+    from starlette.applications import Starlette
+    from starlette.responses import Response as AsgiResponse, JSONResponse, PlainTextResponse, StreamingResponse
+    from starlette.routing import Route
+
+    async def telegram_webhook(req):
+        # Telegram присылает секрет, заданный в setWebhook; чужие запросы не пускаем
+        token = req.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not secrets.compare_digest(token, WEBHOOK_SECRET):
+            metrics.inc("wolt_webhook_rejected_total")
+            return AsgiResponse(status_code=403)
+        try:
+            payload = await req.json()
+            update = Update.de_json(payload, app.bot)
+        except Exception:
+            return AsgiResponse(status_code=400)
+        # Балансировщик шлёт куда угодно: апдейт пользователя из чужой доли отдаём её воркеру
+        target = cluster.route_target(update)
+        if target is not None:
+            await cluster.route(target, json.dumps(payload, ensure_ascii=False))
+        else:
+            await app.update_queue.put(update)
+        return AsgiResponse(status_code=200)
+
+    async def home(req):
+        return PlainTextResponse("Bot is running!")
+
+    async def health(req):
+        return JSONResponse(health_payload())
+
+    async def ready(req):
+        status, payload = ready_payload()
+        return JSONResponse(payload, status_code=status)
+
+    async def metrics_endpoint(req):
+        return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')
+
+    async def locations_json(req):
+        status, headers, body = location_snapshot.serve(
+            req.headers.get('If-None-Match'),
+            req.headers.get('Accept-Encoding', '')
+        )
+        return AsgiResponse(body, status_code=status, headers=headers)
+
+    async def locations_compact_json(req):
+        status, headers, body = compact_snapshot.serve(
+            req.headers.get('If-None-Match'),
+            req.headers.get('Accept-Encoding', '')
+        )
+        return AsgiResponse(body, status_code=status, headers=headers)
+
+    async def stats_json(req):
+        return JSONResponse(stats_payload(), headers=FEED_HEADERS)
+
+    async def locations_since(req):
+        delta = feed_delta(req.query_params.get('cursor'), req.query_params.get('format'))
+        if delta is None:
+            return AsgiResponse(status_code=204, headers=FEED_HEADERS)
+        return JSONResponse(delta, headers=FEED_HEADERS)
+
+    async def locations_stream(req):
+        cursor = req.headers.get('Last-Event-ID') or req.query_params.get('cursor')
+        fmt = req.query_params.get('format')
+
+        async def stream(cursor):
+            yield "retry: 5000\n\n"
+            while True:
+                delta = feed_delta(cursor, fmt)
+                if delta is not None:
+                    cursor = delta['cursor']
+                    yield sse_event(delta)
+                if not await location_feed.wait_async(cursor, SSE_KEEPALIVE):
+                    yield ": keepalive\n\n"
+
+        return StreamingResponse(stream(cursor), media_type='text/event-stream', headers=SSE_HEADERS)
+
+    return Starlette(routes=[
+        Route(WEBHOOK_PATH, telegram_webhook, methods=['POST']),
+        Route('/', home),
+        Route('/health', health),
+        Route('/ready', ready),
+        Route('/metrics', metrics_endpoint),
+        Route('/locations.json', locations_json),
+        Route('/locations.compact.json', locations_compact_json),
+        Route('/stats.json', stats_json),
+        Route('/locations/since', locations_since),
+        Route('/locations/stream', locations_stream),
+    ])
+
+async def run_webhook(app):
+    """Webhook-режим: PTB без Updater, апдейты кладёт в очередь ASGI-хендлер"""
+    import uvicorn
+
+    webserver = uvicorn.Server(uvicorn.Config(
+        build_asgi_app(app),
+        host='0.0.0.0',
+        port=int(os.environ.get("PORT", 10000)),
+        limit_concurrency=SERVER_CONCURRENCY,
+        log_level='warning',
+    ))
+    
+    # HTTP поднимаем сразу: /health отвечает во время старта, /ready — после app.start()
+    serving = asyncio.create_task(webserver.serve())
+    try:
+        with startup.phase("initialize"):
+            await app.initialize()
+        try:
+            # run_polling/run_webhook сами зовут post_init, здесь — вручную
+            await post_init(app)
+            with startup.phase("set_webhook"):
+                # Webhook у бота один: ставит лидер, URL и секрет у всех воркеров общие
+                if await cluster.try_lead():
+                    await app.bot.set_webhook(
+                        url=f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+                        secret_token=WEBHOOK_SECRET,
+                        max_connections=WEBHOOK_MAX_CONNECTIONS,
+                        allowed_updates=Update.ALL_TYPES,
+                        # Перезапуск одного воркера не должен выбрасывать апдейты, адресованные остальным
+                        drop_pending_updates=not cluster.enabled
+                    )
+                else:
+                    log_event("webhook_set_skipped", reason="not_leader", worker=cluster.worker_id)
+            await app.start()
+            log_event("webhook_started", url=f"{WEBHOOK_URL}{WEBHOOK_PATH}", port=webserver.config.port)
+            try:
+                await serving
+            finally:
+                await app.stop()
+                await post_shutdown(app)
+        finally:
+            await app.shutdown()
+    finally:
+        # Старт бота упал — гасим и HTTP, иначе процесс останется живым, но бесполезным
+        if not serving.done():
+            webserver.should_exit = True
+            await serving
+
 # --- ЗАПУСК ---
+def build_state(bot_data):
+    """Индексы и снимки из загруженного bot_data (сами индексы не хранятся)"""
+    with startup.phase("build_indexes"):
+        store = get_location_store(bot_data)
+        store.prune()
+        hotspot_index.rebuild(store)
+        # Черновики выбора регионов и ожидание точки зоны — по ключу на пользователя (в кластере kv
+        # сливается целиком по ключу); общие словари прежних версий выбрасываем
+        bot_data.pop('temp_regions', None)
+        bot_data.pop('zone_pending', None)
+        # Пользователи из pickle и старых версий — dict; в памяти держим компактные Subscriber
+        users = bot_data.setdefault('users', {})
+        for uid, udata in users.items():
+            if not isinstance(udata, Subscriber):
+                users[uid] = Subscriber.from_dict(udata)
+        subscriber_index.rebuild(users)
+        update_snapshots(build_snapshot(store))
+    return bot_data
+
+def load_state(persistence):
+    """База и индексы; в main() запускается в фоне, параллельно со сборкой PTB и getMe"""
+    with startup.phase("load_db"):
+        bot_data = persistence.load()
+    return build_state(bot_data)
+
+async def post_init(app):
+    if isinstance(app.persistence, SQLitePersistence):
+        with startup.phase("wait_state"):
+            bot_data = await startup.preloaded()
+            if bot_data is None:
+                bot_data = await asyncio.to_thread(load_state, app.persistence)
+        app.bot_data.update(bot_data)
+        app.persistence.start(app.bot_data)
+    else:
+        build_state(app.bot_data)
+    cluster.start(app)
+    
+    # Фоновая публикация в GitHub живёт в том же event loop, что и бот
+    publisher.start()
+
+async def startup_ready_job(context: ContextTypes.DEFAULT_TYPE):
+    # JobQueue стартует в app.start() — после запуска polling или установки webhook
+    startup.mark_ready()
+
+async def post_shutdown(app):
+    await cluster.stop()
+    await publisher.stop()
+
 def main():
-    print(f"\n{'='*60}")
-    print(f"🚀 BOT STARTING")
-    print(f"{'='*60}")
-    print(f"Bot Token: {'SET' if BOT_TOKEN else 'MISSING'}")
-    print(f"GitHub Token: {'SET' if GITHUB_TOKEN else 'MISSING'}")
-    print(f"Channel: {CHANNEL_ID}")
-    print(f"Admin: {SUPER_ADMIN_ID}")
-    print(f"{'='*60}\n")
-    
-    # ✅ УДАЛЯЕМ WEBHOOK
-    print("🗑️ Deleting webhook...")
-    try:
-        url = f"https://api.telegram.org/bot{BOT_TOKEN}/deleteWebhook"
-        response = requests.post(url, timeout=10)
-        if response.status_code == 200:
-            print("✅ Webhook deleted")
-        else:
-            print(f"⚠️ Webhook deletion failed: {response.status_code}")
-    except Exception as e:
-        print(f"⚠️ Error deleting webhook: {e}")
+    setup_logging()
+    log_event(
+        "bot_starting",
+        bot_token='SET' if BOT_TOKEN else 'MISSING',
+        github_token='SET' if GITHUB_TOKEN else 'MISSING',
+        channel=CHANNEL_ID, admin=SUPER_ADMIN_ID
+    )
     
-    # Запускаем Flask в отдельном потоке
-    threading.Thread(target=run_flask, daemon=True).start()
+    if cluster.enabled and not WEBHOOK_URL:
+        # getUpdates пускает только одного получателя — несколько воркеров работают лишь за webhook
+        log_event("cluster_requires_webhook", logging.ERROR, workers=cluster.workers)
+        sys.exit(1)
     
-    # Настройка персистентности
-    persistence = PicklePersistence(filepath="bot_data.pickle")
+    if cluster.enabled and not os.getenv("WEBHOOK_SECRET"):
+        # Telegram помнит один секрет — со своим случайным каждый воркер, кроме последнего, отвечал бы 403
+        log_event("cluster_requires_webhook_secret", logging.ERROR, workers=cluster.workers)
+        sys.exit(1)
     
-    # Создание приложения
-    app = ApplicationBuilder().token(BOT_TOKEN).persistence(persistence).build()
+    if not WEBHOOK_URL:
+        # Flask первым: /health отвечает сразу, /ready — когда бот начнёт разбирать апдейты.
+        # Отдельный deleteWebhook не нужен — run_polling сам снимает webhook при старте
+        threading.Thread(target=run_flask, daemon=True).start()
     
-    # Регистрация хендлеров
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("addadmin", add_admin))
-    app.add_handler(CommandHandler("removeadmin", remove_admin))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, menu_button_handler))  # Для кнопки меню
-    app.add_handler(CallbackQueryHandler(button_handler))
-    app.add_handler(MessageHandler(filters.LOCATION, handle_location))
+    # Настройка персистентности (первый запуск на SQLite переносит данные из pickle)
+    with startup.phase("open_db"):
+        if not os.path.exists(DB_FILE) and os.path.exists(PICKLE_FILE):
+            migrate_pickle()
+        # Воркерам кластера нужны чужие правки быстро — сбрасываем свои так же часто, как дочитываем
+        persistence = SQLitePersistence(
+            DB_FILE, update_interval=CLUSTER_SYNC_INTERVAL if cluster.enabled else PERSISTENCE_INTERVAL
+        )
+    # Пока PTB собирается и ходит в getMe, база читается в фоне
+    startup.preload(load_state, persistence)
+    
+    with startup.phase("build_app"):
+        # Создание приложения (в webhook-режиме Updater не нужен — апдейты приходят в ASGI)
+        builder = ApplicationBuilder().token(BOT_TOKEN).persistence(persistence).concurrent_updates(UPDATE_CONCURRENCY)
+        if WEBHOOK_URL:
+            builder = builder.updater(None)
+        else:
+            builder = builder.post_init(post_init).post_shutdown(post_shutdown)
+        app = builder.build()
+        
+        # Регистрация хендлеров
+        app.add_handler(CommandHandler("start", start))
+        app.add_handler(CommandHandler("addadmin", add_admin))
+        app.add_handler(CommandHandler("removeadmin", remove_admin))
+        app.add_handler(CommandHandler("ratelimit", rate_limit))
+        app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, menu_button_handler))  # Для кнопки меню
+        app.add_handler(CallbackQueryHandler(button_handler))
+        app.add_handler(MessageHandler(filters.LOCATION, handle_location))
+        
+        # Все хендлеры выше (и добавленные позже) попадают в wolt_handler_seconds
+        instrument_handlers(app)
+    
+    # Периодическая чистка устаревших меток
+    app.job_queue.run_repeating(prune_locations_job, interval=LOCATIONS_PRUNE_INTERVAL, first=LOCATIONS_PRUNE_INTERVAL)
+    # Сводки для пользователей в режиме digest и после тихих часов
+    app.job_queue.run_repeating(digest_job, interval=DIGEST_TICK, first=DIGEST_TICK)
+    # Брошенные черновики выбора регионов и точки зоны
+    app.job_queue.run_repeating(expire_drafts_job, interval=LOCATIONS_PRUNE_INTERVAL, first=LOCATIONS_PRUNE_INTERVAL)
+    # Первый запуск задачи = приложение запущено: отмечаем готовность для /ready
+    app.job_queue.run_once(startup_ready_job, when=0)
     
-    print("🤖 Bot started!")
-    print(f"📊 Flask on port {os.environ.get('PORT', 10000)}")
-    print(f"🎯 Listening for locations\n")
+    log_event("bot_started", port=int(os.environ.get('PORT', 10000)), mode='webhook' if WEBHOOK_URL else 'polling')
     
-    # ✅ ЗАПУСК POLLING (НЕ WEBHOOK!)
-    app.run_polling(drop_pending_updates=True)
+    if WEBHOOK_URL:
+        asyncio.run(run_webhook(app))
+    else:
+        # ✅ ЗАПУСК POLLING
+        app.run_polling(drop_pending_updates=True)
 
 if __name__ == '__main__':
-    main()
+    # python bot.py migrate [bot_data.pickle] [bot_data.sqlite3]
+    if len(sys.argv) > 1 and sys.argv[1] == 'migrate':
+        setup_logging()
+        migrate_pickle(*sys.argv[2:4])
+    else:
+        main()
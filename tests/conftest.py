@@ -0,0 +1,46 @@
+import os
+import sys
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+# bot.py читает окружение при импорте
+os.environ.setdefault('BOT_TOKEN', '123456:test')
+os.environ.setdefault('GITHUB_MIRROR', '0')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def fresh_indexes():
+    """Индексы и гистограммы — синглтоны модуля: между тестами начинаем с пустых"""
+    bot.fine_stats.load()
+    bot.fine_stats.drain()
+    bot.subscriber_index.rebuild({})
+    bot.hotspot_index.rebuild(())
+    bot.draft_touched.clear()
+    yield
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / 'bot_data.sqlite3')
+
+
+def make_worker(db_path, name):
+    """Воркер над общей базой: персистентность, его bot_data и контекст для хелперов вида user_changed"""
+    persistence = bot.SQLitePersistence(db_path, worker_id=name)
+    bot_data = bot.build_state(persistence.load())
+    persistence.attach(bot_data)
+    context = SimpleNamespace(bot_data=bot_data, application=SimpleNamespace(persistence=persistence))
+    return SimpleNamespace(persistence=persistence, bot_data=bot_data, context=context)
+
+
+def make_location(message_id, lat=32.0853, lon=34.7818):
+    now = datetime.now().isoformat()
+    return {
+        'latitude': lat, 'longitude': lon, 'timestamp': now, 'user': 'Курьер',
+        'message_id': message_id, 'report_count': 1, 'last_seen': now,
+    }
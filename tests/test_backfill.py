@@ -0,0 +1,90 @@
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+import backfill
+import bot
+from conftest import make_worker
+
+
+def export(tmp_path, messages):
+    path = tmp_path / 'result.json'
+    # Ключи до "messages" и строки со скобками/кавычками/кириллицей — чтобы разрезы кусков попадали куда угодно
+    path.write_text(json.dumps({
+        'name': 'Wolt "чат" [архив]', 'type': 'private_supergroup', 'id': 1, 'messages': messages,
+    }, ensure_ascii=False, indent=1), encoding='utf-8')
+    return str(path)
+
+
+def message(mid, when, reply_to=None, point=None, text="метка ] } \" {"):
+    msg = {
+        'id': mid, 'type': 'message', 'date': when.isoformat(timespec='seconds'),
+        'date_unixtime': str(int(when.timestamp())), 'from': f"Курьер {mid}",
+        'text': [text, {'type': 'bold', 'text': '}]'}],
+    }
+    if reply_to:
+        msg['reply_to_message_id'] = reply_to
+    if point:
+        msg['location_information'] = {'latitude': point[0], 'longitude': point[1]}
+    return msg
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 64, 1 << 20])
+def test_iter_messages_across_chunk_boundaries(tmp_path, chunk_size):
+    now = datetime.now().replace(microsecond=0)
+    messages = [message(i, now, point=(32 + i / 100, 34.8) if i % 2 else None) for i in range(1, 40)]
+    path = export(tmp_path, messages)
+    assert list(backfill.iter_messages(path, chunk_size=chunk_size)) == messages
+
+
+def test_iter_messages_rejects_truncated_export(tmp_path):
+    path = tmp_path / 'result.json'
+    path.write_text('{"messages": [{"id": 1, "type": "message"}, {"id": 2, "ty', encoding='utf-8')
+    with pytest.raises(json.JSONDecodeError):
+        list(backfill.iter_messages(str(path), chunk_size=8))
+
+
+def test_extract_locations_uses_unixtime(tmp_path):
+    start = datetime(2026, 3, 1, 12, 0)
+    messages = [
+        {'id': 100, 'type': 'service', 'date': start.isoformat(), 'date_unixtime': str(int(start.timestamp()))},
+        message(101, start + timedelta(hours=1), reply_to=100, point=(32.08, 34.78)),
+        message(102, start + timedelta(hours=2), reply_to=101, point=(31.97, 34.79)),
+        message(103, start + timedelta(hours=3), point=(32.5, 35.0)),   # вне ветки
+        message(104, start + timedelta(days=2), reply_to=100, point=(32.1, 34.8)),
+    ]
+    # 'date' экспорта — в поясе машины, где его делали; должен браться date_unixtime
+    messages[1]['date'] = '1999-01-01T00:00:00'
+
+    locs = list(backfill.extract_locations(messages, 100, until='2026-03-02'))
+    assert [loc['message_id'] for loc in locs] == [101, 102]
+    assert locs[0]['timestamp'] == locs[0]['last_seen'] == (start + timedelta(hours=1)).isoformat()
+
+
+def test_backfill_twice_loads_once(tmp_path, db_path, monkeypatch):
+    monkeypatch.setattr(backfill, 'bot', bot)
+    now = datetime.now().replace(microsecond=0)
+    messages = [message(1, now - timedelta(days=40))] + [
+        message(i, now - timedelta(days=10, minutes=i), reply_to=1, point=(32.08, 34.78)) for i in range(2, 12)
+    ] + [message(20, now - timedelta(minutes=5), reply_to=1, point=(31.97, 34.79))]
+    path = export(tmp_path, messages)
+
+    def run():
+        worker = make_worker(db_path, 'backfill')
+        job = backfill.Backfill(worker.bot_data, 1, batch_size=4)
+        for loc in backfill.extract_locations(backfill.iter_messages(path, chunk_size=32), 1):
+            job.add(loc)
+        counts = job.finish()
+        worker.persistence.mark_kv(job.mark_key)
+        backfill.asyncio.run(backfill.persist(worker.persistence, worker.bot_data, publish=False))
+        return counts, worker
+
+    counts, worker = run()
+    assert counts['loaded'] == 11 and counts['in_store'] == 1 and counts['skipped'] == 0
+    assert worker.persistence.db.execute("SELECT SUM(n) FROM stats_hours").fetchone()[0] == 11
+
+    counts, worker = run()
+    assert counts['loaded'] == 0 and counts['skipped'] == 11
+    assert worker.persistence.db.execute("SELECT SUM(n) FROM stats_hours").fetchone()[0] == 11
+    assert [loc['message_id'] for loc in worker.bot_data['locations']] == [20]
@@ -0,0 +1,147 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import bot
+from conftest import make_location, make_worker
+
+
+def flush(worker):
+    asyncio.run(worker.persistence.flush_changes())
+
+
+def pull(worker):
+    return asyncio.run(worker.persistence.pull_changes())
+
+
+def test_pull_applies_rows_and_tombstones(db_path):
+    a, b = make_worker(db_path, 'A'), make_worker(db_path, 'B')
+    # Стартовые пометки (region_bits) уходят первым сбросом
+    flush(a)
+    flush(b)
+
+    a.bot_data['users'][1] = bot.Subscriber(bot.region_mask(['tel_aviv']), notifications=True)
+    a.bot_data['users'][2] = bot.Subscriber(bot.region_mask(['rishon']), notifications=True)
+    bot.user_changed(a.context, 1)
+    bot.user_changed(a.context, 2)
+    a.bot_data['admins'].add(9)
+    store_a = bot.get_location_store(a.bot_data)
+    store_a.append(make_location(1))
+    store_a.append(make_location(2))
+    bot.set_draft(a.context, 'temp_regions:1', {'bat_yam'})
+    flush(a)
+
+    assert pull(b)
+    assert set(b.bot_data['users']) == {1, 2}
+    assert b.bot_data['admins'] == {9}
+    assert [loc['message_id'] for loc in b.bot_data['locations']] == [1, 2]
+    assert b.bot_data['temp_regions:1'] == {'bat_yam'}
+    # Пришедшее от A обратно в базу не пишется
+    changes, _ = b.persistence._collect()
+    assert not any(changes.values())
+
+    # Удаления на B доходят до A надгробиями
+    del b.bot_data['users'][2]
+    bot.user_changed(b.context, 2)
+    b.bot_data['admins'].discard(9)
+    bot.get_location_store(b.bot_data).remove_where(lambda loc: loc['message_id'] == 1)
+    bot.pop_draft(b.context, 'temp_regions:1')
+    flush(b)
+
+    assert pull(a)
+    assert set(a.bot_data['users']) == {1}
+    assert a.bot_data['admins'] == set()
+    assert [loc['message_id'] for loc in store_a] == [2]
+    assert 'temp_regions:1' not in a.bot_data
+    changes, _ = a.persistence._collect()
+    assert not any(changes.values())
+
+
+def test_pull_keeps_unflushed_local_edits(db_path):
+    a, b = make_worker(db_path, 'A'), make_worker(db_path, 'B')
+    a.bot_data['users'][1] = bot.Subscriber(bot.region_mask(['tel_aviv']), notifications=True)
+    bot.user_changed(a.context, 1)
+    a.bot_data['ingest_limits'] = {'user': [1, 1], 'chat': [1, 1]}
+    bot.kv_changed(a.context, 'ingest_limits')
+    flush(a)
+    pull(b)
+
+    # Обе стороны правят одно и то же; B сбрасывает первым, A ещё нет
+    b.bot_data['users'][1]['notifications'] = False
+    bot.user_changed(b.context, 1)
+    b.bot_data['ingest_limits'] = {'user': [2, 2], 'chat': [2, 2]}
+    bot.kv_changed(b.context, 'ingest_limits')
+    a.bot_data['users'][1]['regions'] = ['rishon']
+    bot.user_changed(a.context, 1)
+    a.bot_data['ingest_limits'] = {'user': [3, 3], 'chat': [3, 3]}
+    bot.kv_changed(a.context, 'ingest_limits')
+    flush(b)
+    pull(a)
+
+    assert a.bot_data['users'][1]['regions'] == ['rishon']
+    assert a.bot_data['ingest_limits'] == {'user': [3, 3], 'chat': [3, 3]}
+
+
+def test_pulled_fines_are_not_counted_twice(db_path):
+    a, b = make_worker(db_path, 'A'), make_worker(db_path, 'B')
+    loc = make_location(1)
+    bot.get_location_store(a.bot_data).append(loc)
+    bot.fine_stats.record(loc)
+    flush(a)
+
+    pull(b)
+    flush(b)
+    total = a.persistence.db.execute("SELECT SUM(n) FROM stats_hours").fetchone()[0]
+    assert total == 1
+
+
+def make_cluster(db_path, index, lease_ttl=15):
+    cluster = bot.Cluster(worker_id=f"w{index}", workers=2, index=index, lease_ttl=lease_ttl)
+    cluster.persistence = bot.SQLitePersistence(db_path, worker_id=cluster.worker_id)
+    return cluster
+
+
+def test_lease_takeover(db_path, monkeypatch):
+    first, second = make_cluster(db_path, 0), make_cluster(db_path, 1)
+    assert first._acquire_lease()
+    assert not second._acquire_lease()
+    # Продление своей аренды
+    assert first._acquire_lease()
+
+    # Лидер пропал, аренда истекла — забирает второй, первый уже не может
+    now = bot.time.time()
+    monkeypatch.setattr(bot.time, 'time', lambda: now + 16)
+    assert second._acquire_lease()
+    assert not first._acquire_lease()
+
+    # Отданная аренда достаётся сразу, без ожидания LEASE_TTL
+    second._release_lease()
+    assert first._acquire_lease()
+
+
+def test_updates_are_routed_to_owner(db_path):
+    first, second = make_cluster(db_path, 0), make_cluster(db_path, 1)
+    payload = {
+        'update_id': 1,
+        'message': {
+            'message_id': 5, 'date': 0, 'text': '/start',
+            'chat': {'id': 7, 'type': 'private'},
+            'from': {'id': 7, 'is_bot': False, 'first_name': 'Курьер'},
+        },
+    }
+    update = bot.Update.de_json(payload, None)
+    assert first.route_target(update) == 1
+    assert second.route_target(update) is None
+
+    async def scenario():
+        await first.route(1, json.dumps(payload))
+        queue = asyncio.Queue()
+        task = asyncio.create_task(second._route_loop(SimpleNamespace(update_queue=queue, bot=None)))
+        try:
+            return await asyncio.wait_for(queue.get(), 2)
+        finally:
+            task.cancel()
+
+    routed = asyncio.run(scenario())
+    assert routed.update_id == 1 and routed.effective_user.id == 7
+    assert first._take_routed() == [] and second._take_routed() == []
@@ -0,0 +1,108 @@
+import asyncio
+import pickle
+
+import bot
+from conftest import make_location, make_worker
+
+
+def flush(worker):
+    asyncio.run(worker.persistence.flush_changes())
+
+
+def test_migrate_pickle_round_trip(tmp_path, db_path):
+    pickle_path = tmp_path / 'bot_data.pickle'
+    zone = {'lat': 32.1, 'lon': 34.8, 'radius': 2}
+    legacy = {
+        'users': {
+            1: {'regions': ['tel_aviv', 'rishon'], 'notifications': True},
+            2: {'regions': [], 'notifications': False, 'zone': zone, 'delivery': 'digest', 'digest_min': 30},
+        },
+        'admins': {5, 6},
+        'locations': [make_location(10), make_location(11, lat=31.97)],
+        'ingest_limits': {'user': [2, 1], 'chat': [30, 10]},
+    }
+    with open(pickle_path, 'wb') as f:
+        pickle.dump({'bot_data': legacy, 'user_data': {}, 'chat_data': {}}, f)
+
+    bot.migrate_pickle(str(pickle_path), db_path)
+    worker = make_worker(db_path, 'A')
+
+    users = worker.bot_data['users']
+    assert set(users) == {1, 2}
+    assert sorted(users[1]['regions']) == ['rishon', 'tel_aviv'] and users[1]['notifications']
+    assert users[2].get('zone') == zone and users[2].get('delivery') == 'digest' and users[2].get('digest_min') == 30
+    assert worker.bot_data['admins'] == {5, 6}
+    assert [loc['message_id'] for loc in worker.bot_data['locations']] == [10, 11]
+    assert worker.bot_data['ingest_limits'] == {'user': [2, 1], 'chat': [30, 10]}
+    assert worker.bot_data['region_bits'] == list(bot.REGION_ORDER)
+    # Только что загруженное состояние переписывать нечего
+    changes, _ = worker.persistence._collect()
+    assert not any(changes.values())
+
+
+def test_restart_sees_changes_and_deletions(db_path):
+    worker = make_worker(db_path, 'A')
+    users = worker.bot_data['users']
+    users[1] = bot.Subscriber(bot.region_mask(['tel_aviv']), notifications=True)
+    users[2] = bot.Subscriber(bot.region_mask(['rishon']), notifications=True)
+    bot.user_changed(worker.context, 1)
+    bot.user_changed(worker.context, 2)
+    worker.bot_data['admins'].add(7)
+    store = bot.get_location_store(worker.bot_data)
+    store.append(make_location(1))
+    store.append(make_location(2))
+    bot.set_draft(worker.context, 'temp_regions:1', {'bat_yam'})
+    bot.set_draft(worker.context, 'zone_pending:2', True)
+    flush(worker)
+
+    del users[2]
+    bot.user_changed(worker.context, 2)
+    store.remove_where(lambda loc: loc['message_id'] == 1)
+    bot.pop_draft(worker.context, 'zone_pending:2')
+    worker.bot_data['ingest_limits'] = {'user': [1, 1], 'chat': [5, 5]}
+    bot.kv_changed(worker.context, 'ingest_limits')
+    flush(worker)
+
+    restarted = make_worker(db_path, 'B')
+    assert set(restarted.bot_data['users']) == {1}
+    assert restarted.bot_data['users'][1]['regions'] == ['tel_aviv']
+    assert restarted.bot_data['admins'] == {7}
+    assert [loc['message_id'] for loc in restarted.bot_data['locations']] == [2]
+    assert restarted.bot_data['temp_regions:1'] == {'bat_yam'}
+    assert 'zone_pending:2' not in restarted.bot_data
+    assert restarted.bot_data['ingest_limits'] == {'user': [1, 1], 'chat': [5, 5]}
+
+
+def test_flush_writes_only_marked_rows(db_path):
+    worker = make_worker(db_path, 'A')
+    store = bot.get_location_store(worker.bot_data)
+    for mid in range(100):
+        store.append(make_location(mid))
+    worker.bot_data['big'] = list(range(1000))
+    bot.kv_changed(worker.context, 'big')
+    flush(worker)
+
+    store.append(make_location(500))
+    # Изменение без пометки не пишется: kv сохраняются только по kv_changed
+    worker.bot_data['big'].append(1)
+    changes, _ = worker.persistence._collect()
+    assert {name: len(rows) for name, rows in changes.items() if rows} == {'locations_add': 1}
+
+
+def test_failed_write_is_retried(db_path, monkeypatch):
+    worker = make_worker(db_path, 'A')
+    bot.get_location_store(worker.bot_data).append(make_location(1))
+    worker.bot_data['users'][1] = bot.Subscriber(notifications=True)
+    bot.user_changed(worker.context, 1)
+
+    write = worker.persistence._write
+    def failing(changes):
+        raise RuntimeError("disk full")
+    monkeypatch.setattr(worker.persistence, '_write', failing)
+    flush(worker)
+    monkeypatch.setattr(worker.persistence, '_write', write)
+    flush(worker)
+
+    restarted = make_worker(db_path, 'B')
+    assert set(restarted.bot_data['users']) == {1}
+    assert [loc['message_id'] for loc in restarted.bot_data['locations']] == [1]
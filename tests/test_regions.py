@@ -0,0 +1,92 @@
+import random
+from math import cos, radians, sin
+
+import pytest
+
+import bot
+
+
+def brute_force(regions, lat, lon):
+    """Прежний get_location_region: все регионы подряд, ближайший центр среди накрывших точку"""
+    best, best_dist = None, None
+    for r_id, r_data in regions.items():
+        dist = bot.calculate_distance(lat, lon, *r_data['coords'])
+        if dist <= r_data['radius'] and (best_dist is None or dist < best_dist):
+            best, best_dist = r_id, dist
+    return best
+
+
+def sample_points(regions, count=20000, seed=1):
+    rng = random.Random(seed)
+    lats = [r['coords'][0] for r in regions.values()]
+    lons = [r['coords'][1] for r in regions.values()]
+    points = [
+        (rng.uniform(min(lats) - 0.3, max(lats) + 0.3), rng.uniform(min(lons) - 0.3, max(lons) + 0.3))
+        for _ in range(count)
+    ]
+    # И точки у самой границы каждого круга — изнутри и снаружи, под разными углами
+    for r in regions.values():
+        lat, lon = r['coords']
+        for k in range(72):
+            angle = radians(k * 5)
+            for scale in (0.995, 1.005):
+                km = r['radius'] * scale
+                points.append((
+                    lat + km / 111.0 * cos(angle),
+                    lon + km / (111.32 * cos(radians(lat))) * sin(angle),
+                ))
+    return points
+
+
+@pytest.mark.parametrize('cell_deg', [bot.REGION_CELL_DEG, 0.013, 0.5])
+def test_lookup_matches_brute_force(cell_deg):
+    index = bot.RegionIndex(bot.REGIONS, cell_deg)
+    for lat, lon in sample_points(bot.REGIONS):
+        assert index.lookup(lat, lon)[0] == brute_force(bot.REGIONS, lat, lon), (lat, lon)
+
+
+def test_classify_matches_brute_force():
+    points = sample_points(bot.REGIONS, count=5000, seed=2)
+    expected = [brute_force(bot.REGIONS, lat, lon) for lat, lon in points]
+    assert bot.region_index.classify(points, chunk=1000) == expected
+
+
+def test_lookup_outside_all_regions():
+    assert bot.region_index.lookup(0.0, 0.0) == (None, None)
+
+
+def test_recipients_match_brute_force():
+    rng = random.Random(3)
+    ids = list(bot.REGIONS)
+    users = {}
+    for uid in range(1, 3001):
+        zone = None
+        if rng.random() < 0.2:
+            lat, lon = bot.REGIONS[rng.choice(ids)]['coords']
+            zone = {'lat': lat + rng.uniform(-0.1, 0.1), 'lon': lon + rng.uniform(-0.1, 0.1),
+                    'radius': rng.choice(bot.ZONE_RADIUS_CHOICES)}
+        users[uid] = bot.Subscriber(
+            bot.region_mask(rng.sample(ids, rng.randint(0, 3))), notifications=rng.random() < 0.8, zone=zone
+        )
+    index = bot.SubscriberIndex()
+    index.rebuild(users)
+    # Правки после сборки: смена настроек и удаления переставляют строки колонок
+    for uid in rng.sample(list(users), 500):
+        if rng.random() < 0.5:
+            del users[uid]
+            index.remove(uid)
+        else:
+            users[uid]['regions'] = rng.sample(ids, rng.randint(0, 2))
+            users[uid]['notifications'] = not users[uid]['notifications']
+            index.update(uid, users[uid])
+
+    for lat, lon in sample_points(bot.REGIONS, count=300, seed=4)[:600]:
+        rid = bot.region_index.lookup(lat, lon)[0]
+        expected = {
+            uid for uid, sub in users.items() if sub['notifications'] and (
+                rid in sub['regions'] or (sub.get('zone') and bot.calculate_distance(
+                    lat, lon, sub['zone']['lat'], sub['zone']['lon']) <= sub['zone']['radius'])
+            )
+        }
+        got = set(index.recipients(rid)) | index.zones.match(lat, lon)
+        assert got == expected, (lat, lon)